@@ -0,0 +1,465 @@
+'''Benchmarks of the workflow's Python hot paths on synthetic data.'''
+
+
+import json
+import multiprocessing as mp
+import numpy as np
+import os
+from os import makedirs
+from os.path import abspath, dirname, exists, join
+import pandas as pd
+import queue
+import re
+import resource
+import time
+from utils import Block_Writer, RANK_CODES, scrub_fastq_captions, standardize_metaphlan, standardize_bracken, \
+    bracken_native, merge_xtree, load_taxid, standardize_xtree, merge_tables, diversity, extract_unclassified_kraken
+
+
+RANKS = list(RANK_CODES.values())
+LINEAGE_CODES = ['d', 'p', 'c', 'o', 'f', 'g', 's']
+
+
+# --- Synthetic inputs --- #
+
+
+def make_standardized_csvs(out_dir, num_samples, num_taxa = 20000, taxa_per_sample = 500, seed = 0):
+    # Single-sample unified format reports drawn from a shared pool of taxa
+    if not exists(out_dir):
+        makedirs(out_dir)
+    rng = np.random.default_rng(seed)
+    clades = np.array(['Taxon {}'.format(i) for i in range(num_taxa)])
+    fis = []
+    for j in range(num_samples):
+        idx = np.sort(rng.choice(num_taxa, taxa_per_sample, replace = False))
+        sample = 'sample_{}'.format(j)
+        df = pd.DataFrame({'classifier' : 'kraken_bracken', 'clade' : clades[idx], 'tax_id' : idx + 1, \
+                           sample : rng.dirichlet(np.ones(taxa_per_sample))})
+        fi = join(out_dir, sample + '_species.csv')
+        df.to_csv(fi, header = True, index = False)
+        fis.append(fi)
+    return fis
+
+
+def make_fastq_pair(out_dir, num_pairs, read_len = 150, seed = 0):
+    # Gzipped paired-end reads with Illumina-style headers, captions on the '+' lines and mate suffixes
+    if not exists(out_dir):
+        makedirs(out_dir)
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b'ACGT', dtype = np.uint8)
+    qual = b'F' * read_len
+    fos = [join(out_dir, 'reads_1.fastq.gz'), join(out_dir, 'reads_2.fastq.gz')]
+    for d, fo in enumerate(fos):
+        with Block_Writer(fo, 1, 1) as f_out:
+            for start in range(0, num_pairs, 10000):
+                n = min(10000, num_pairs - start)
+                seqs = bases[rng.integers(0, 4, size = (n, read_len))]
+                recs = []
+                for i in range(n):
+                    rid = 'A00123:8:H7KJ3DSXX:1:1101:{}:{}/{}'.format(start + i, 1000 + (start + i) % 997, d + 1)
+                    recs.append(b'@%s\n%s\n+%s\n%s\n' % (rid.encode(), seqs[i].tobytes(), rid.encode(), qual))
+                f_out.write(b''.join(recs))
+    return fos
+
+
+def make_kraken_output(fo, num_pairs, unclassified = 0.3, read_len = 150, seed = 0):
+    # Per-read Kraken2 output in the same order as make_fastq_pair()'s reads
+    rng = np.random.default_rng(seed)
+    status = np.where(rng.random(num_pairs) < unclassified, 'U', 'C')
+    taxids = np.where(status == 'U', 0, rng.integers(2, 100000, size = num_pairs))
+    with open(fo, 'w') as f_out:
+        for i in range(num_pairs):
+            f_out.write('{}\tA00123:8:H7KJ3DSXX:1:1101:{}:{}\t{}\t{}|{}\t{}:116 |:| {}:116\n'.format( \
+                status[i], i, 1000 + i % 997, taxids[i], read_len, read_len, taxids[i], taxids[i]))
+    return fo
+
+
+def make_bracken_reports(out_dir, num_samples, taxa_per_rank = 300, seed = 0):
+    # Bracken's per-rank output for each sample, laid out as raw_bracken/{sample}/{rank}.tsv
+    rng = np.random.default_rng(seed)
+    fis = []
+    for j in range(num_samples):
+        sample_dir = join(out_dir, 'sample_{}'.format(j))
+        if not exists(sample_dir):
+            makedirs(sample_dir)
+        for k, rank in enumerate(RANKS):
+            n = max(taxa_per_rank >> k, 5)
+            reads = rng.integers(10, 100000, size = n)
+            df = pd.DataFrame({'name' : ['{} {}'.format(rank.capitalize(), i) for i in range(n)], \
+                               'taxonomy_id' : np.arange(n) + 1000 * (k + 1), 'taxonomy_lvl' : rank[0].upper(), \
+                               'kraken_assigned_reads' : reads, 'added_reads' : reads // 10, 'new_est_reads' : reads + reads // 10, \
+                               'fraction_total_reads' : ['%0.5f' % f for f in (reads * 1.1) / (reads * 1.1).sum()]})
+            fi = join(sample_dir, rank + '.tsv')
+            df.to_csv(fi, sep = '\t', header = True, index = False)
+            fis.append(fi)
+    return fis
+
+
+def make_lineages(num_taxa, seed = 0):
+    # GTDB-style lineages, with a few suffixed (ex. _A) and repeated names as in real databases
+    rng = np.random.default_rng(seed)
+    parts = []
+    for r, code in enumerate(LINEAGE_CODES):
+        n = max(num_taxa // (4 ** (len(LINEAGE_CODES) - 1 - r)), 2)
+        idx = np.sort(rng.integers(0, n, size = num_taxa))
+        names = np.array(['{}{}'.format(code.upper(), i) for i in range(n)])[idx]
+        if code == 's':
+            names = np.char.add(np.char.add(np.array(['G{}_'.format(i) for i in idx]), names), \
+                                np.where(rng.random(num_taxa) < 0.05, '_A', ''))
+        parts.append(np.char.add('{}__'.format(code), names))
+    return [';'.join(p) for p in zip(*parts)]
+
+
+def make_metaphlan_reports(out_dir, num_samples, num_clades = 1000, seed = 0):
+    # MetaPhlAn 4 reports (-t rel_ab_w_read_stats) with nested clades down to strains (t__)
+    if not exists(out_dir):
+        makedirs(out_dir)
+    rng = np.random.default_rng(seed)
+    lineages = make_lineages(num_clades, seed)
+    taxids = {}
+    fis = []
+    for j in range(num_samples):
+        rows = {}
+        for i in np.sort(rng.choice(num_clades, size = num_clades // 2, replace = False)):
+            comps = lineages[i].replace('d__', 'k__').split(';') + ['t__SGB{}'.format(i)]
+            for k in range(1, len(comps) + 1):
+                clade = '|'.join(comps[:k])
+                if clade not in rows:
+                    ids = [str(taxids.setdefault(c, len(taxids) + 2)) for c in comps[:k]]
+                    rows[clade] = ('|'.join(ids), rng.random() * 10)
+        fi = join(out_dir, 'sample_{}.metaphlan'.format(j))
+        with open(fi, 'w') as f_out:
+            f_out.write('#mpa_vJan21_CHOCOPhlAnSGB_202103\n#metaphlan --nproc 30 -t rel_ab_w_read_stats\n')
+            f_out.write('#1000000 reads processed\n#SampleID\tMetaphlan_Analysis\n#estimated_reads_mapped_to_known_clades:900000\n')
+            f_out.write('#clade_name\tclade_taxid\trelative_abundance\tcoverage\testimated_number_of_reads_from_the_clade\n')
+            f_out.write('UNCLASSIFIED\t-1\t10.0\t-\t1000\n')
+            for clade, (ids, ra) in rows.items():
+                f_out.write('{}\t{}\t{:.5f}\t{:.3f}\t{}\n'.format(clade, ids, ra, ra / 10, int(ra * 100)))
+        fis.append(fi)
+    return fis
+
+
+def make_xtree_table(fo, num_genomes, num_samples, seed = 0):
+    # A merged XTree relative abundance table (lineage x sample) as written by merge_xtree()
+    rng = np.random.default_rng(seed)
+    lineages = make_lineages(num_genomes, seed)
+    mat = rng.random((num_genomes, num_samples)) * (rng.random((num_genomes, num_samples)) < 0.1)
+    mat /= np.maximum(mat.sum(axis = 0), 1e-12)
+    with open(fo, 'w') as f_out:
+        f_out.write('\t'.join('sample_{}'.format(j) for j in range(num_samples)) + '\n')
+        for l, row in zip(lineages, mat):
+            f_out.write(l + '\t' + '\t'.join('%.15g' % v for v in row) + '\n')
+    return fo, lineages
+
+
+def make_names_dmp(fo, num_names, lineages = ()):
+    # A slice of NCBI's names.dmp that includes the species and genera of the given lineages
+    extra = set()
+    for l in lineages:
+        for c in l.split(';')[-2:]:
+            extra.add(re.sub(r'\s[A-Z]$', '', c.split('__')[1].replace('_', ' ')))
+    with open(fo, 'w') as f_out:
+        for i in range(num_names):
+            f_out.write('{}\t|\tOrganism {}\t|\t\t|\t{}\t|\n'.format(i + 1, i, 'scientific name' if i % 3 else 'synonym'))
+        for k, n in enumerate(sorted(extra)):
+            f_out.write('{}\t|\t{}\t|\t\t|\tscientific name\t|\n'.format(num_names + k + 1, n))
+    return fo
+
+
+def make_xtree_outputs(out_dir, num_genomes, num_samples, seed = 0):
+    # Per-sample XTree .cov/.ref files and the reference to taxonomy mapping
+    if not exists(out_dir):
+        makedirs(out_dir)
+    rng = np.random.default_rng(seed)
+    genomes = ['GCF_{:09d}.1 Synthetic genome {}'.format(i, i) for i in range(num_genomes)]
+    lineages = make_lineages(num_genomes, seed)
+    mappings = join(out_dir, 'xtree_mapping.tsv')
+    with open(mappings, 'w') as f_out:
+        for g, l in zip(genomes, lineages):
+            f_out.write('{}\t{}\n'.format(g.split(' ')[0], l))
+    covs = []
+    for j in range(num_samples):
+        idx = np.sort(rng.choice(num_genomes, max(num_genomes // 10, 1), replace = False))
+        cov = join(out_dir, 'sample_{}.cov'.format(j))
+        with open(cov, 'w') as f_out:
+            f_out.write('Reference\tBases_covered\tProportion_covered\tUnique_bases_covered\tUnique_proportion_covered\tExpected\n')
+            for i in idx:
+                f_out.write('{}\t{}\t{:.6f}\t{}\t{:.6f}\t{:.6f}\n'.format(genomes[i], 1000, rng.random() * 0.05, 100, \
+                                                                        rng.random() * 0.01, rng.random()))
+        with open(cov[:-4] + '.ref', 'w') as f_out:
+            for i in idx[rng.random(len(idx)) < 0.8]:
+                f_out.write('{}\t{}\n'.format(genomes[i], rng.integers(1, 10000)))
+        covs.append(cov)
+    return covs, mappings
+
+
+def make_kreport(fo, kmer_distrib, num_species, seed = 0):
+    # A Kraken2 report over a synthetic taxonomy from domain to strain, and a matching Bracken k-mer distribution
+    rng = np.random.default_rng(seed)
+    codes = ['D', 'P', 'C', 'O', 'F', 'G', 'S', 'S1']
+    widths = [1, 2, 4, 8, 16, 32, num_species, num_species] # Taxa per level, each under the one above
+    taxa = [] # (depth, code, taxid, parent index)
+    first = 2
+    level_start = []
+    for d, (code, w) in enumerate(zip(codes, widths)):
+        level_start.append(len(taxa))
+        for i in range(w):
+            parent = -1 if d == 0 else level_start[d - 1] + i * widths[d - 1] // w
+            taxa.append((d + 1, code, first, parent))
+            first += 1
+    lvl_reads = np.where(rng.random(len(taxa)) < 0.5, rng.integers(0, 5000, size = len(taxa)), 0)
+    all_reads = lvl_reads.copy()
+    for i in range(len(taxa) - 1, -1, -1):
+        if taxa[i][3] >= 0:
+            all_reads[taxa[i][3]] += all_reads[i]
+    children = {}
+    for i, t in enumerate(taxa):
+        children.setdefault(t[3], []).append(i)
+    with open(fo, 'w') as f_out:
+        f_out.write('10.00\t1000\t1000\tU\t0\tunclassified\n')
+        f_out.write('90.00\t{}\t0\tR\t1\troot\n'.format(all_reads[children[-1]].sum()))
+        stack = list(reversed(children[-1]))
+        while stack: # Depth-first, as Kraken2 writes it
+            i = stack.pop()
+            depth, code, taxid, _ = taxa[i]
+            f_out.write('1.00\t{}\t{}\t{}\t{}\t{}Taxon {}\n'.format(all_reads[i], lvl_reads[i], code, taxid, '  ' * depth, taxid))
+            stack.extend(reversed(children.get(i, [])))
+    strains = [t[2] for t in taxa if t[1] == 'S1']
+    with open(kmer_distrib, 'w') as f_out:
+        f_out.write('mapped_taxid\tgenome_taxids:kmers_mapped:total_genome_kmers\n')
+        for t in taxa:
+            gs = rng.choice(strains, size = min(len(strains), 20), replace = False)
+            f_out.write('{}\t{}\n'.format(t[2], ' '.join('{}:{}:100000'.format(g, rng.integers(1, 50000)) for g in gs)))
+    return fo, kmer_distrib
+
+
+def make_sample_sheet(out_dir, num_samples):
+    # A sample sheet of empty read files, which is all that a dry-run looks at
+    if not exists(out_dir):
+        makedirs(out_dir)
+    fo = join(out_dir, 'samples.csv')
+    with open(fo, 'w') as f_out:
+        f_out.write('sample_name,illumina_fwd,illumina_rev\n')
+        for i in range(num_samples):
+            fqs = [join(out_dir, 'sample_{}_{}.fastq.gz'.format(i, d)) for d in ['1', '2']]
+            for fq in fqs:
+                open(fq, 'a').close()
+            f_out.write('sample_{},{},{}\n'.format(i, *fqs))
+    return fo
+
+
+# --- Measurement --- #
+
+
+def rss_mb(field):
+    # Current (VmRSS) or peak (VmHWM) resident memory of this process's own address space
+    # ru_maxrss would do for the peak elsewhere, but Linux carries it over from the parent's pages through fork and exec
+    try:
+        with open('/proc/self/status', 'r') as f_in:
+            for l in f_in:
+                if l.startswith(field + ':'):
+                    return int(l.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_and_report(q, func, args):
+    start_rss = rss_mb('VmRSS')
+    start = time.time()
+    cpu_start = time.process_time()
+    try:
+        func(*args)
+    except Exception as e: # Hand the failure back rather than leaving the parent waiting
+        q.put(e)
+        return
+    q.put({'wall_s' : time.time() - start, 'cpu_s' : time.process_time() - cpu_start, \
+           'peak_rss_mb' : rss_mb('VmHWM'), 'start_rss_mb' : start_rss})
+
+
+def measure(func, *args):
+    # Run in a freshly spawned interpreter rather than a fork, which would start with the parent's resident pages
+    # (ex. earlier benchmarks' inputs), so the peak RSS is this call's plus the imports every run shares (start_rss_mb)
+    ctx = mp.get_context('spawn')
+    q = ctx.Queue()
+    p = ctx.Process(target = run_and_report, args = (q, func, args))
+    p.start()
+    res = None
+    while res is None:
+        try:
+            res = q.get(timeout = 1)
+        except queue.Empty:
+            if not p.is_alive() and q.empty(): # Ex. the child couldn't import the caller's main module
+                raise RuntimeError('Benchmark of {} exited with {} before reporting'.format(func.__name__, p.exitcode))
+    p.join()
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+
+# --- Benchmarks --- #
+# Each takes a scratch directory and a scale factor, generates its inputs, and measures one call
+
+
+def dry_run(snakefile, work_dir, samples, configfiles, config):
+    from snakemake import snakemake # Only needed here, and slow to import
+    if not snakemake(snakefile, config = dict(config, work_dir = work_dir, samples = samples), configfiles = configfiles, \
+                     workdir = work_dir, cores = 1, dryrun = True, quiet = True):
+        raise RuntimeError('Dry-run of {} failed'.format(snakefile))
+
+
+def bench_scrub(work_dir, scale):
+    fwd, _ = make_fastq_pair(work_dir, 10000 * scale)
+    return measure(scrub_fastq_captions, fwd, join(work_dir, 'scrubbed_1.fastq.gz'))
+
+
+def bench_extract_unclassified(work_dir, scale):
+    fwd, rev = make_fastq_pair(work_dir, 10000 * scale)
+    kraken = make_kraken_output(join(work_dir, 'kraken.tsv'), 10000 * scale)
+    return measure(extract_unclassified_kraken, kraken, fwd, rev, join(work_dir, 'unclassified_1.fastq.gz'), \
+                   join(work_dir, 'unclassified_2.fastq.gz'))
+
+
+def bench_metaphlan(work_dir, scale):
+    fis = make_metaphlan_reports(join(work_dir, 'raw'), 10 * scale)
+    out_dir = join(work_dir, 'standardized')
+    makedirs(out_dir, exist_ok = True)
+    return measure(standardize_metaphlan, fis, out_dir, 0.0001)
+
+
+def bench_bracken(work_dir, scale):
+    fis = make_bracken_reports(join(work_dir, 'raw'), 10 * scale)
+    out_dir = join(work_dir, 'standardized')
+    makedirs(out_dir, exist_ok = True)
+    return measure(standardize_bracken, fis, out_dir, 0.0001)
+
+
+def bench_bracken_native(work_dir, scale):
+    makedirs(work_dir, exist_ok = True)
+    kreport, kmer_distrib = make_kreport(join(work_dir, 'kreport.tsv'), join(work_dir, 'database150mers.kmer_distrib'), 1000 * scale)
+    bracken_native(kreport, kmer_distrib, work_dir) # Index the k-mer distribution outside of the measurement
+    return measure(bracken_native, kreport, kmer_distrib, work_dir)
+
+
+def bench_merge_xtree(work_dir, scale):
+    covs, mappings = make_xtree_outputs(join(work_dir, 'xtree'), 10000, 10 * scale)
+    return measure(merge_xtree, covs, work_dir, 'bench', 0.01, 0.005, 0.001, mappings, 4)
+
+
+def bench_load_taxid(work_dir, scale):
+    makedirs(work_dir, exist_ok = True)
+    names = make_names_dmp(join(work_dir, 'names.dmp'), 100000 * scale)
+    index = join(work_dir, 'names.sqlite')
+    if exists(index):
+        os.remove(index)
+    return measure(load_taxid, names, index)
+
+
+def bench_xtree(work_dir, scale):
+    makedirs(work_dir, exist_ok = True)
+    fi, lineages = make_xtree_table(join(work_dir, 'bench_ra.tsv'), 1000 * scale, 50)
+    names = make_names_dmp(join(work_dir, 'names.dmp'), 100000, lineages)
+    index = join(work_dir, 'names.sqlite')
+    load_taxid(names, index).close() # Index the taxonomy dump outside of the measurement
+    return measure(standardize_xtree, fi, work_dir, names, 0.001, index)
+
+
+def bench_merge(work_dir, scale):
+    fis = make_standardized_csvs(work_dir, 10 * scale)
+    return measure(merge_tables, fis, join(work_dir, 'merged.csv'))
+
+
+def bench_diversity(work_dir, scale):
+    fis = make_standardized_csvs(join(work_dir, 'standardized'), 10 * scale)
+    merged = join(work_dir, 'metaphlan_species.csv')
+    merge_tables(fis, merged)
+    return measure(diversity, [merged], join(work_dir, 'alpha_species.csv'), join(work_dir, 'beta_species.csv'))
+
+
+def bench_dry_run(work_dir, scale):
+    # Parsing the Snakefile and building the DAG of the full workflow for 100 samples per scale step
+    # Not yet measured with Snakemake installed, so there is no baseline or target for it
+    main_dir = dirname(dirname(abspath(__file__)))
+    samples = make_sample_sheet(join(work_dir, 'reads'), 100 * scale)
+    db = join(work_dir, 'db')
+    makedirs(db, exist_ok = True)
+    names = join(db, 'names.dmp')
+    kmer_distrib = join(db, 'database100mers.kmer_distrib')
+    for f in [names, kmer_distrib]:
+        open(f, 'a').close()
+    config = {'env_yamls' : join(main_dir, 'configs', 'conda'), 'kraken_bracken_database' : db, 'read_len' : 100, \
+              'ncbi_tax_names' : names}
+    configfiles = [join(main_dir, 'test_data', 'parameters.yaml'), join(main_dir, 'test_data', 'resources.yaml')]
+    return measure(dry_run, join(main_dir, 'workflow', 'Snakefile'), join(work_dir, 'work'), samples, configfiles, config)
+
+
+BENCHMARKS = {
+    'scrub_fastq_captions' : bench_scrub,
+    'extract_unclassified_kraken' : bench_extract_unclassified,
+    'standardize_metaphlan' : bench_metaphlan,
+    'standardize_bracken' : bench_bracken,
+    'bracken_native' : bench_bracken_native,
+    'merge_xtree' : bench_merge_xtree,
+    'load_taxid' : bench_load_taxid,
+    'standardize_xtree' : bench_xtree,
+    'merge_tables' : bench_merge,
+    'diversity' : bench_diversity,
+    'dry_run' : bench_dry_run,
+}
+
+# Wall time limits (seconds) that hold regardless of the baseline, by benchmark and scale (ex. {'dry_run' : {'100x' : 30}})
+# Only limits that have been met on a real run belong here, so dry-run performance (unmeasured so far) has none
+TARGETS = {}
+
+# Scale factors run unless others are given, with the 10,000-sample merge on top of the usual ones
+DEFAULT_SCALES = (1, 10, 100)
+EXTRA_SCALES = {
+    'merge_tables' : (1000,),
+}
+
+
+def run_benchmarks(work_dir, names = None, scales = None):
+    # Results are keyed by benchmark, then by scale factor
+    results = {}
+    for name in (names if names else BENCHMARKS):
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark {}, choose from {}'.format(name, ', '.join(BENCHMARKS)))
+        results[name] = {}
+        for s in (scales if scales else DEFAULT_SCALES + EXTRA_SCALES.get(name, ())):
+            results[name]['{}x'.format(s)] = BENCHMARKS[name](join(work_dir, name, '{}x'.format(s)), s)
+    return results
+
+
+# --- Baselines --- #
+
+
+def check_targets(results, targets = TARGETS):
+    # Benchmarks and scales that ran over their wall time target
+    return [(name, scale, res['wall_s'], targets[name][scale]) for name, by_scale in results.items() \
+            for scale, res in by_scale.items() if res['wall_s'] > targets.get(name, {}).get(scale, float('inf'))]
+
+
+def save_baseline(results, fo):
+    with open(fo, 'w') as f_out:
+        json.dump(results, f_out, indent = 4)
+
+
+def compare_to_baseline(results, baseline, tolerance = 0.2):
+    # One row per benchmark and scale in both, flagging those more than tolerance slower or larger than the baseline
+    base = baseline
+    if isinstance(baseline, str):
+        with open(baseline, 'r') as f_in:
+            base = json.load(f_in)
+    rows = []
+    for name, by_scale in results.items():
+        for scale, res in by_scale.items():
+            if scale not in base.get(name, {}):
+                continue
+            old = base[name][scale]
+            wall = res['wall_s'] / max(old['wall_s'], 1e-9)
+            rss = res['peak_rss_mb'] / max(old['peak_rss_mb'], 1e-9)
+            rows.append({'benchmark' : name, 'scale' : scale, 'wall_s' : res['wall_s'], 'baseline_wall_s' : old['wall_s'], \
+                         'wall_ratio' : wall, 'peak_rss_mb' : res['peak_rss_mb'], 'baseline_peak_rss_mb' : old['peak_rss_mb'], \
+                         'rss_ratio' : rss, 'regression' : wall > 1 + tolerance or rss > 1 + tolerance})
+    return pd.DataFrame(rows, columns = ['benchmark', 'scale', 'wall_s', 'baseline_wall_s', 'wall_ratio', 'peak_rss_mb', \
+                                         'baseline_peak_rss_mb', 'rss_ratio', 'regression'])
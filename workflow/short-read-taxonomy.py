@@ -5,12 +5,14 @@ import click
 from click_default_group import DefaultGroup
 from contextlib import redirect_stdout
 from io import StringIO
+import json
 from os import getcwd, makedirs
 from os.path import abspath, dirname, exists, join
-import pandas as pd
-from snakemake import snakemake, main
 from shutil import rmtree
-from utils import Workflow_Dirs, print_cmds, cleanup_files
+
+
+# Snakemake, pandas and the workflow utilities are imported by the commands that use them,
+# so that --help, --version, and the commands that don't need them start quickly
 
 
 @click.group(cls = DefaultGroup, default = 'run', default_if_no_args = True)
@@ -18,13 +20,19 @@ def cli():
     pass
 
 
-def sbatch(workflow, work_dir, samples, env_yamls, pyaml, ryaml, cores, env_dir, s_dir):
+def sbatch(workflow, work_dir, samples, env_yamls, pyaml, ryaml, cores, env_dir, s_dir, preview = 0):
+    from snakemake import main
+    import yaml
+    from utils import bundle_components
+    with open(ryaml, 'r') as f_in:
+        components = bundle_components(yaml.safe_load(f_in))
     cfg_wd = 'work_dir=%s' % work_dir
     cfg_sp = 'samples=%s' % samples
     cfg_ey = 'env_yamls=%s' % env_yamls
+    cfg_pv = 'preview=%s' % preview
     main([
         '--snakefile',      workflow, 
-        '--config',         *{cfg_wd, cfg_sp, cfg_ey},
+        '--config',         *{cfg_wd, cfg_sp, cfg_ey, cfg_pv},
         '--configfiles',    *[pyaml, ryaml],
         '--jobs',           str(cores),
         '--restart-times',  '2',
@@ -34,17 +42,20 @@ def sbatch(workflow, work_dir, samples, env_yamls, pyaml, ryaml, cores, env_dir,
         '--printshellcmds',
         '--keep-going',
         '--latency-wait',   '60',
+        '--group-components', *['{}={}'.format(g, n) for g, n in components.items()],
         '--profile',        s_dir
     ])
 
 
-def cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml, cores, env_dir, dry_run, unlock):
+def cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml, cores, env_dir, dry_run, unlock, preview = 0):
+    from snakemake import snakemake
     snakemake(
         workflow,
         config = {
             'work_dir': work_dir,
             'samples': samples,
-            'env_yamls': env_yamls
+            'env_yamls': env_yamls,
+            'preview': preview
         },
         configfiles = [
             pyaml,
@@ -83,9 +94,12 @@ def cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml, cores, env_di
     help = 'Set up directory structure and print workflow commands to be run separately')
 @click.option('--unlock', is_flag = True, default = False, \
     help = 'Remove a lock on the work directory')
+@click.option('--preview', type = float, default = 0, \
+    help = 'Profile a seeded subsample of N read pairs per sample (or, if N < 1, that fraction of them) \n\
+    in work_dir/preview, with sampling depths in final_reports/sampling_depth.csv')
 @click.option('--version', is_flag = True, default = False, \
     help = 'Check the module version')
-def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock, version): # unit_test
+def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock, preview, version): # unit_test
     # Get the absolute path of the Snakefile to find the profile configs
     main_dir = dirname(dirname(abspath(__file__))) # /path/to/main_dir/workflow/cli.py
     workflow = join(main_dir, 'workflow', 'Snakefile')
@@ -107,31 +121,38 @@ def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock,
         makedirs(env_dir)
     env_yamls = join(main_dir, 'configs', 'conda')
 
+    # Keep a preview's outputs (and its intermediates) apart from the full run's
+    if preview < 0:
+        raise click.BadParameter('must be a number of read pairs, a fraction, or 0', param_hint = '--preview')
+    if preview:
+        work_dir = join(work_dir, 'preview')
+
     # If generating unit tests, set the unit test directory (by default, is pytest's default, .tests)
     # unit_test_dir = join(main_dir, '.tests/unit') if unit_test else None
 
     # If rules failed previously, unlock the directory
     if unlock:
         cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml,   \
-                 cores, env_dir, False, unlock) # unit_test_dir
+                 cores, env_dir, False, unlock, preview) # unit_test_dir
         rmtree(join(getcwd(), '.snakemake'))
         
     # Run workflow
     if slurm:
         sbatch(workflow, work_dir, samples, env_yamls, pyaml, ryaml,     \
-               cores, env_dir, join(main_dir, 'configs', 'sbatch'))
+               cores, env_dir, join(main_dir, 'configs', 'sbatch'), preview)
     elif dry_run:
+        from utils import Workflow_Dirs, print_cmds
         # Set up the directory structure skeleton
         Workflow_Dirs(work_dir, 'short-read-taxonomy')
         # Print the dry run standard out
         f = StringIO()
         with redirect_stdout(f):
             cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml,   \
-                     cores, env_dir, True, False) # unit_test_dir
+                     cores, env_dir, True, False, preview) # unit_test_dir
         print_cmds(f.getvalue())
     else:
         cmd_line(workflow, work_dir, samples, env_yamls, pyaml, ryaml,   \
-                 cores, env_dir, False, False) # unit_test_dir
+                 cores, env_dir, False, False, preview) # unit_test_dir
 
 
 @cli.command('cleanup')
@@ -140,6 +161,8 @@ def run(cores, work_dir, samples, parameters, resources, slurm, dry_run, unlock,
 @click.option('-s', '--samples', type = click.Path(), required = True, \
     help = 'Sample CSV in format [sample_name,...,]')
 def cleanup(work_dir, samples): 
+    import pandas as pd
+    from utils import cleanup_files
     df = pd.read_csv(samples, header = 0, index_col = 0) # name, fwd, rev
     cleanup_files(work_dir, df)
 
@@ -166,9 +189,96 @@ def test():
              10, env_dir, False, False)
 
 
+@cli.command('profile')
+@click.option('-d', '--work_dir', type = click.Path(), required = True, \
+    help = 'Absolute path to working directory')
+@click.option('-r', '--resources', type = click.Path(), required = False, \
+    help = 'Absolute path to the computational resources YAML file the run used')
+@click.option('-n', '--top', type = int, default = 10, show_default = True, \
+    help = 'Number of slowest rules to list')
+@click.option('-l', '--low', type = float, default = 0.5, show_default = True, \
+    help = 'Fraction of the requested memory or CPU below which a request counts as over-sized')
+def profile(work_dir, resources, top, low):
+    import yaml
+    from utils import collect_benchmarks, summarize_profile
+    main_dir = dirname(dirname(abspath(__file__)))
+    ryaml = resources if resources else join(main_dir, 'configs', 'resources.yaml')
+    with open(ryaml, 'r') as f_in:
+        res = yaml.safe_load(f_in)
+    prof = collect_benchmarks(join(work_dir, 'logs', 'benchmarks'))
+    if prof.empty:
+        raise click.ClickException('No rule benchmarks found under {}'.format(join(work_dir, 'logs', 'benchmarks')))
+    summary = summarize_profile(prof, res, low)
+    print('Slowest rules (seconds, MB):')
+    print(summary.head(top)[['rule', 'jobs', 'total_s', 'mean_s', 'max_s', 'max_rss_mb', 'io_in_mb', 'io_out_mb']].to_string(index = False))
+    flagged = summary[summary['flags'] != '']
+    if len(flagged):
+        print('\nResource requests to revisit in {}:'.format(ryaml))
+        print(flagged[['rule', 'threads', 'cpu_efficiency', 'mem_mb', 'max_rss_mb', 'mem_efficiency', 'flags']].to_string(index = False))
+
+
+@cli.command('check_bracken')
+@click.option('-k', '--kreport', type = click.Path(), required = False, \
+    help = 'Kraken2 report (default: test_data/bracken/kreport.tsv)')
+@click.option('-m', '--kmer_distrib', type = click.Path(), required = False, \
+    help = 'Bracken databaseXmers.kmer_distrib (default: test_data/bracken/database100mers.kmer_distrib)')
+@click.option('-e', '--expected', type = click.Path(), required = False, \
+    help = 'Directory of the bracken CLI\'s {rank}.tsv for the report (default: test_data/bracken/expected)')
+@click.option('-t', '--threshold', type = int, default = 10, show_default = True, \
+    help = 'Minimum reads for a taxon to be re-estimated, as bracken -t')
+def check_bracken(kreport, kmer_distrib, expected, threshold):
+    from utils import compare_bracken
+    fixture = join(dirname(dirname(abspath(__file__))), 'test_data', 'bracken')
+    diffs = compare_bracken(kreport if kreport else join(fixture, 'kreport.tsv'), \
+                            kmer_distrib if kmer_distrib else join(fixture, 'database100mers.kmer_distrib'), \
+                            expected if expected else join(fixture, 'expected'), threshold)
+    if len(diffs):
+        print(diffs.to_string(index = False))
+        raise click.ClickException('The native Bracken estimates differ from the expected tables')
+    print('The native Bracken estimates match the expected tables at all six ranks')
+
+
+@cli.command('benchmark')
+@click.option('-d', '--work_dir', type = click.Path(), required = True, \
+    help = 'Absolute path to a scratch directory for the synthetic benchmark data')
+@click.option('-o', '--output', type = click.Path(), required = False, \
+    help = 'Write the results to this JSON file (ex. to use as a baseline) instead of printing them')
+@click.option('-b', '--baseline', type = click.Path(), required = False, \
+    help = 'JSON file of earlier results to compare against')
+@click.option('-n', '--names', type = str, default = '', \
+    help = 'Comma-separated benchmarks to run (default: all)')
+@click.option('-s', '--scales', type = str, default = '', \
+    help = 'Comma-separated scale factors of the synthetic inputs (default: 1,10,100, and 1000 for merge_tables)')
+@click.option('-t', '--tolerance', type = float, default = 0.2, \
+    help = 'Fraction slower or larger than the baseline that counts as a regression')
+def benchmark(work_dir, output, baseline, names, scales, tolerance):
+    from benchmark import run_benchmarks, save_baseline, compare_to_baseline, check_targets
+    res = run_benchmarks(work_dir, [n.strip() for n in names.split(',') if n.strip()], \
+                         [int(s) for s in scales.split(',') if s.strip()])
+    if output:
+        save_baseline(res, output)
+    else:
+        print(json.dumps(res, indent = 4))
+    missed = check_targets(res)
+    if missed:
+        raise click.ClickException('Over the wall time target: {}'.format(', '.join( \
+            '{} ({}): {:.1f}s > {}s'.format(*m) for m in missed)))
+    if baseline:
+        cmp = compare_to_baseline(res, baseline, tolerance)
+        if cmp.empty:
+            raise click.ClickException('No benchmarks or scales in common with {}'.format(baseline))
+        print(cmp.to_string(index = False))
+        if cmp['regression'].any():
+            raise click.ClickException('Regressions against {}: {}'.format(baseline, \
+                ', '.join(cmp[cmp['regression']]['benchmark'] + ' (' + cmp[cmp['regression']]['scale'] + ')')))
+
+
 cli.add_command(run)
 cli.add_command(cleanup)
 cli.add_command(test)
+cli.add_command(profile)
+cli.add_command(check_bracken)
+cli.add_command(benchmark)
 
 
 if __name__ == '__main__':
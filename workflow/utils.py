@@ -4,31 +4,165 @@
 # --- Workflow setup --- #
 
 
+import bz2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import fcntl
 import gzip
+import hashlib
+import numpy as np
 import os
 from os import makedirs, symlink
-from os.path import abspath, basename, exists, join
+from os.path import abspath, basename, dirname, exists, join
 import pandas as pd
+import queue
+import re
+from scipy import sparse
 import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 
-def extract_from_gzip(ap, out):
-    if open(ap, 'rb').read(2) != b'\x1f\x8b': # If the input is not gzipped
-        with open(ap, 'rb') as f_in, gzip.open(out, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    else: # Otherwise, symlink
-        symlink(ap, out)
+MANIFEST_COLS = ['sample', 'dir', 'source', 'size', 'mtime_ns', 'hash', 'format', 'staged']
 
 
-def ingest_samples(samples, tmp):
-    df = pd.read_csv(samples, header = 0, index_col = 0) # name, fwd, rev
-    s = list(df.index)
-    lst = df.values.tolist()
-    for i,l in enumerate(lst):
-        if not exists(join(tmp, s[i] + '_1.fastq.gz')):
-            extract_from_gzip(abspath(l[0]), join(tmp, s[i] + '_1.fastq.gz'))
-            extract_from_gzip(abspath(l[1]), join(tmp, s[i] + '_2.fastq.gz'))
-    return s
+def ingest_samples(samples):
+    # Read with the csv module rather than pandas, since this runs every time the Snakefile is parsed
+    with open(samples, 'r', newline = '') as f_in:
+        rows = csv.reader(f_in)
+        next(rows, None) # name, fwd, rev
+        return {r[0] : [abspath(r[1]), abspath(r[2])] for r in rows if r}
+
+
+def load_batches(fi):
+    # Sample-to-batch assignments recorded by save_batches
+    assigned = {}
+    if fi and exists(fi):
+        with open(fi, 'r') as f_in:
+            for l in f_in:
+                vals = l.rstrip('\n').split('\t')
+                if len(vals) == 2 and vals[0] != 'sample':
+                    assigned[vals[0]] = vals[1]
+    return assigned
+
+
+def make_batches(samples, size, fi = None):
+    # Batches of at most size samples (none if size is 0). Samples keep the batch recorded for them in fi,
+    # and the rest go into new batches in sample sheet order, so adding samples to a cohort never renames
+    # or refills an existing batch (which would re-run every one of its samples)
+    if size <= 0:
+        return {}
+    assigned = load_batches(fi)
+    batches = {}
+    for s in samples:
+        if s in assigned:
+            batches.setdefault(assigned[s], []).append(s)
+    new = [s for s in samples if s not in assigned]
+    start = max([int(b.split('_')[-1]) + 1 for b in set(assigned.values())], default = 0)
+    for i in range(0, len(new), size):
+        batches['batch_' + str(start + i // size).zfill(5)] = new[i:i + size]
+    return batches
+
+
+def save_batches(batches, fo):
+    # Record the batches' assignments, keeping those of samples no longer in the sample sheet
+    assigned = load_batches(fo)
+    assigned.update({s : b for b, smps in batches.items() for s in smps})
+    makedirs(dirname(fo), exist_ok = True)
+    with open(fo + '.tmp', 'w') as f_out:
+        f_out.write('sample\tbatch\n')
+        for s, b in assigned.items():
+            f_out.write('{}\t{}\n'.format(s, b))
+    os.replace(fo + '.tmp', fo)
+
+
+def sniff_format(fi):
+    with open(fi, 'rb') as f:
+        head = f.read(14)
+    if head[:2] == b'\x1f\x8b':
+        if len(head) == 14 and head[3] & 4 and head[12:14] == b'BC': # BGZF blocks carry a 'BC' extra subfield
+            return 'bgzip'
+        return 'gzip'
+    if head[:3] == b'BZh':
+        return 'bz2'
+    return 'plain'
+
+
+def fast_hash(fi, n = 1 << 20):
+    # Hash of the size and the first and last n bytes, which is enough to notice a replaced file
+    size = os.path.getsize(fi)
+    h = hashlib.blake2b(str(size).encode(), digest_size = 16)
+    with open(fi, 'rb') as f:
+        h.update(f.read(n))
+        if size > n:
+            f.seek(max(n, size - n))
+            h.update(f.read(n))
+    return h.hexdigest()
+
+
+def load_manifest(tmp):
+    manifest = {}
+    fi = join(tmp, 'manifest.tsv')
+    if exists(fi):
+        with open(fi, 'r') as f_in:
+            for l in f_in:
+                vals = l.rstrip('\n').split('\t')
+                if len(vals) == len(MANIFEST_COLS) and vals[0] != 'sample':
+                    row = dict(zip(MANIFEST_COLS, vals))
+                    manifest[(row['sample'], row['dir'])] = row # Later entries supersede earlier ones
+    return manifest
+
+
+def file_unchanged(fi, size, mtime_ns, hsh):
+    # Whether a file is the one previously recorded by its size, mtime, and fast hash
+    try:
+        st = os.stat(fi)
+    except OSError:
+        return False
+    if str(st.st_size) != str(size):
+        return False
+    return str(st.st_mtime_ns) == str(mtime_ns) or fast_hash(fi) == hsh
+
+
+def reads_unchanged(row, fi):
+    # Whether the input file is the one recorded in the manifest when it was last staged
+    if row is None or row['source'] != fi:
+        return False
+    return file_unchanged(fi, row['size'], row['mtime_ns'], row['hash'])
+
+
+def stage_reads(fi, fo, manifest, sample, d, threads = 1):
+    fmt = sniff_format(fi)
+    if fmt == 'plain':
+        with open(fi, 'rb') as f:
+            first = f.read(1)
+        if first not in [b'@', b'']:
+            raise ValueError('{}: not a FASTQ, gzipped FASTQ, or bzipped FASTQ'.format(fi))
+    if fmt in ['gzip', 'bgzip']: # Already compressed in a format every downstream tool reads, so symlink
+        if exists(fo) or os.path.islink(fo):
+            os.remove(fo)
+        symlink(fi, fo)
+    else:
+        reader = Block_Reader(fi)
+        try:
+            with Block_Writer(fo, threads, 1) as f_out:
+                for b in reader:
+                    f_out.write(b)
+        finally:
+            reader.close()
+    st = os.stat(fi)
+    row = [sample, d, fi, str(st.st_size), str(st.st_mtime_ns), fast_hash(fi), fmt, fo]
+    with open(manifest, 'a') as f_out: # Rules for different samples may finish at the same time
+        fcntl.flock(f_out, fcntl.LOCK_EX)
+        if f_out.tell() == 0:
+            f_out.write('\t'.join(MANIFEST_COLS) + '\n')
+        f_out.write('\t'.join(row) + '\n')
+        fcntl.flock(f_out, fcntl.LOCK_UN)
 
 
 def check_make(d):
@@ -42,10 +176,15 @@ class Workflow_Dirs:
     TMP = ''
     LOG = ''
 
-    def __init__(self, work_dir, module):
+    def __init__(self, work_dir, module, make = True):
         self.OUT = join(work_dir, module)
         self.TMP = join(work_dir, 'tmp') 
         self.LOG = join(work_dir, 'logs') 
+        if make:
+            self.make()
+
+    def make(self):
+        # Set up the directory skeleton (Snakemake makes any output or log directory itself when it's needed)
         check_make(self.OUT)
         out_dirs = ['0_masked_fastqs', '1_metaphlan', '2_kraken2', '3_xtree', 'final_reports']
         for d in out_dirs: 
@@ -64,14 +203,205 @@ def cleanup_files(work_dir, df):
     smps = list(df.index)
     for d in ['1', '2']:
          for s in smps:
+            for ext in ['.fastq.gz', '.full.fastq.gz']: # Preview runs subsample the staged reads
+                staged_fq = join(work_dir, 'tmp', s + '_' + d + ext)
+                if exists(staged_fq) or os.path.islink(staged_fq): # Compressed inputs are staged as symlinks
+                    os.remove(staged_fq)
             masked_fq = join(work_dir, 'short-read-taxonomy', '0_masked_fastqs', s + '_' + d + '.masked.fastq.gz')
             if exists(masked_fq):
                 os.remove(masked_fq)
-            os.remove(join(work_dir, 'short-read-taxonomy', '1_metaphlan', s + '_' + d + '.fastq'))
-            os.remove(join(work_dir, 'short-read-taxonomy', '1_metaphlan', 'raw_output', s + '.sam'))
-            os.remove(join(work_dir, 'short-read-taxonomy', '1_metaphlan', 'raw_output', s + '.dedup.sam'))
-            os.remove(join(work_dir, 'short-read-taxonomy', '1_metaphlan', 'raw_output', s + '.dedup.txt'))
-            os.remove(join(work_dir, 'short-read-taxonomy', '3_xtree', s + '.fastq'))
+            for ext in ['.fastq', '.fastq.gz']: # Scrubbed reads may or may not have been compressed
+                scrubbed_fq = join(work_dir, 'short-read-taxonomy', '1_metaphlan', s + '_' + d + ext)
+                if exists(scrubbed_fq):
+                    os.remove(scrubbed_fq)
+            for ext in ['.sam', '.dedup.sam', '.dedup.bam']: # The raw SAM is normally removed once deduplicated
+                sam = join(work_dir, 'short-read-taxonomy', '1_metaphlan', 'raw_output', s + ext)
+                if exists(sam):
+                    os.remove(sam)
+            xtree_fq = join(work_dir, 'short-read-taxonomy', '3_xtree', s + '.fastq')
+            if exists(xtree_fq): # Not written when intermediates are streamed
+                os.remove(xtree_fq)
+
+
+# Resources config entries (threads, memory) that each rule requests
+# Rules not listed, or without a memory entry, run with the defaults (ex. the Slurm profile's default-resources)
+RULE_RESOURCES = {
+    'ingest_samples' : ('ingest_threads', None),
+    'preview_reads' : ('preview_threads', None),
+    'mask_reads' : ('mask_reads_threads', None),
+    'scrub_fastq_captions' : ('scrub_fastq_threads', 'scrub_fastq_mem_mb'),
+    'metaphlan' : ('metaphlan_threads', 'metaphlan_mem_mb'),
+    'dedup_metaphlan' : ('metaphlan_threads', None),
+    'extract_unclassified_metaphlan' : ('metaphlan_threads', 'metaphlan_mem_mb'),
+    'kraken2' : ('kraken2_threads', 'kraken2_mem_mb'),
+    'kraken2_batch' : ('kraken2_threads', 'kraken2_mem_mb'),
+    'extract_unclassified_kraken' : ('extract_unclassified_threads', None),
+    'make_xtree_input' : ('xtree_input_threads', 'xtree_input_mem_mb'),
+    'xtree' : ('xtree_threads', 'xtree_mem_mb'),
+    'xtree_batch' : ('xtree_threads', 'xtree_mem_mb'),
+    'merge_xtree_outputs' : ('xtree_threads', None),
+    'standardize_metaphlan' : ('light_threads', 'light_mem_mb'),
+    'standardize_bracken' : ('light_threads', 'light_mem_mb'),
+    'merge_metaphlan' : ('light_threads', 'light_mem_mb'),
+    'merge_bracken' : ('light_threads', 'light_mem_mb'),
+    'make_config' : ('light_threads', 'light_mem_mb'),
+    'sampling_depth' : ('light_threads', 'light_mem_mb'),
+}
+PROFILE_COLS = ['s', 'cpu_time', 'max_rss', 'io_in', 'io_out', 'mean_load']
+
+
+# Job groups of the short rules (see bundle_mode in the resources config), and how many of their
+# connected components are bundled into each submission under --slurm
+# Each standardize job is a component on its own, as a sample's classifiers don't depend on each other
+def bundle_components(resources):
+    return {'standardize' : int(resources.get('bundle_size', 1)), 'summarize' : 12} # Merges of up to two tools x six ranks
+
+
+# Gather Snakemake's per-job benchmark files (logs/benchmarks/{rule}/{job}.tsv) into one table
+def collect_benchmarks(bench_dir, fo = None):
+    dfs = []
+    if exists(bench_dir):
+        for rule in sorted(os.listdir(bench_dir)):
+            for f in sorted(os.listdir(join(bench_dir, rule))):
+                if not f.endswith('.tsv'):
+                    continue
+                df = pd.read_csv(join(bench_dir, rule, f), sep = '\t', header = 0)
+                df = df.reindex(columns = PROFILE_COLS).apply(pd.to_numeric, errors = 'coerce') # '-' if too short to measure
+                df.insert(0, 'job', f[:-4])
+                df.insert(0, 'rule', rule)
+                dfs.append(df)
+    profile = pd.concat(dfs, ignore_index = True) if dfs else pd.DataFrame(columns = ['rule', 'job'] + PROFILE_COLS)
+    if fo:
+        profile.to_csv(fo, sep = '\t', header = True, index = False)
+    return profile
+
+
+# Per-rule totals and peaks of a run profile, with what each rule requested and whether that looks over- or under-sized
+# Memory is over-sized if the largest job used less than low of the request, and under-sized if any job went over it
+# Threads are over-sized if CPU time came to less than low of wall time x threads
+def summarize_profile(profile, resources, low = 0.5):
+    summary = profile.groupby('rule').agg(jobs = ('job', 'count'), total_s = ('s', 'sum'), mean_s = ('s', 'mean'), \
+        max_s = ('s', 'max'), cpu_s = ('cpu_time', 'sum'), max_rss_mb = ('max_rss', 'max'), \
+        io_in_mb = ('io_in', 'sum'), io_out_mb = ('io_out', 'sum'))
+    threads = [resources.get(RULE_RESOURCES.get(r, (None, None))[0]) for r in summary.index]
+    mem = [resources.get(RULE_RESOURCES.get(r, (None, None))[1]) for r in summary.index]
+    summary['threads'] = pd.to_numeric(pd.Series(threads, index = summary.index), errors = 'coerce')
+    summary['mem_mb'] = pd.to_numeric(pd.Series(mem, index = summary.index), errors = 'coerce')
+    cpu_use = summary['cpu_s'] / (summary['total_s'] * summary['threads'].fillna(1))
+    mem_use = summary['max_rss_mb'] / summary['mem_mb']
+    summary['cpu_efficiency'] = cpu_use.round(3)
+    summary['mem_efficiency'] = mem_use.round(3)
+    flags = []
+    for r in summary.index:
+        f = []
+        if mem_use[r] > 1:
+            f.append('mem under-sized')
+        elif mem_use[r] < low:
+            f.append('mem over-sized')
+        if summary.loc[r, 'threads'] > 1 and cpu_use[r] < low:
+            f.append('threads over-sized')
+        flags.append(', '.join(f))
+    summary['flags'] = flags
+    return summary.sort_values('total_s', ascending = False).reset_index()
+
+
+class Disk_Monitor:
+    '''Periodic disk usage of a work directory, broken down by its top two levels of subdirectories.'''
+
+    def __init__(self, root, log, interval = 60):
+        self.root = root
+        self.log = log # Every sample, so the usage up to a failure isn't lost
+        self.interval = interval
+        self.start_time = None
+        self.peaks = {} # Directory -> (bytes, seconds since start)
+        self.last = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def usage(self):
+        # Allocated bytes of the files under each directory up to two levels down, without following symlinks
+        sizes = {'total' : 0}
+        stack = [(self.root, '')]
+        while stack:
+            d, label = stack.pop()
+            try:
+                entries = list(os.scandir(d))
+            except OSError: # Removed mid-walk
+                continue
+            for e in entries:
+                try:
+                    if e.is_dir(follow_symlinks = False):
+                        stack.append((e.path, join(label, e.name) if label.count(os.sep) < 1 else label))
+                        continue
+                    b = e.stat(follow_symlinks = False).st_blocks * 512
+                except OSError:
+                    continue
+                sizes['total'] += b
+                if label:
+                    sizes[label] = sizes.get(label, 0) + b
+        return sizes
+
+    def sample(self):
+        elapsed = round(time.time() - self.start_time)
+        self.last = self.usage()
+        for d, b in self.last.items():
+            if b >= self.peaks.get(d, (-1, 0))[0]:
+                self.peaks[d] = (b, elapsed)
+        makedirs(dirname(self.log), exist_ok = True)
+        with open(self.log, 'a') as f_out:
+            if f_out.tell() == 0:
+                f_out.write('elapsed_s\tdir\tgb\n')
+            for d, b in sorted(self.last.items()):
+                f_out.write('{}\t{}\t{:.3f}\n'.format(elapsed, d, b / 1e9))
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.start_time = time.time()
+        self.sample()
+        if self.interval > 0:
+            self.thread = threading.Thread(target = self.run, daemon = True)
+            self.thread.start()
+
+    def stop(self, fo = None):
+        # Take a last sample and write each directory's high-water mark, largest first
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.start_time is None: # Never started
+            return
+        self.sample()
+        if fo:
+            rows = sorted(self.peaks.items(), key = lambda kv : -kv[1][0])
+            with open(fo, 'w') as f_out:
+                f_out.write('dir\tpeak_gb\tpeak_at_s\tfinal_gb\n')
+                for d, (b, t) in rows:
+                    f_out.write('{}\t{:.3f}\t{}\t{:.3f}\n'.format(d, b / 1e9, t, self.last.get(d, 0) / 1e9))
+
+
+# Count the jobs of a finished run and the cluster submissions they took, from Snakemake's log
+# Every job that wasn't submitted on its own (bundled into a group job, or run locally) saved a submission
+def submission_report(log, fo = None):
+    jobs, submitted, grouped = 0, 0, 0
+    in_stats = False
+    with open(log, 'r') as f_in:
+        for l in f_in:
+            if l.startswith('Job stats:'):
+                in_stats = not jobs # The first table counts every job to run
+            elif in_stats and l.startswith('total'):
+                jobs = int(l.split()[1])
+                in_stats = False
+            elif l.startswith('Submitted group job'):
+                grouped += 1
+            elif l.startswith('Submitted job'):
+                submitted += 1
+    report = pd.DataFrame([{'jobs' : jobs, 'submissions' : submitted + grouped, 'group_submissions' : grouped, \
+                            'saved' : max(jobs - submitted - grouped, 0) if submitted + grouped else 0}])
+    if fo:
+        report.to_csv(fo, sep = '\t', header = True, index = False)
+    return report
 
 
 def print_cmds(f):
@@ -98,158 +428,1208 @@ def print_cmds(f):
 # --- Workflow functions --- #
 
 
-import io
+RANK_CODES = { 's' : 'species', 'g' : 'genus', 'f' : 'family', 'o' : 'order', 'c' : 'class', 'p' : 'phylum'}
+BLOCK_SIZE = 1 << 22 # Bytes of decompressed FASTQ handed around at a time
+RECORD_BATCH = 1 << 16 # FASTQ records processed per block
 
 
-def scrub_fastq_captions(fi, fo):
-    with io.TextIOWrapper(io.BufferedReader(gzip.open(fi, 'rb'))) as f_in, open(fo, 'w') as f_out:
-        for l in f_in:
-            if l.startswith('+'):
-                f_out.write('+\n')
+def open_reads(fi):
+    fmt = sniff_format(fi)
+    if fmt in ['gzip', 'bgzip']:
+        return gzip.open(fi, 'rb')
+    if fmt == 'bz2':
+        return bz2.open(fi, 'rb')
+    return open(fi, 'rb')
+
+
+class Block_Reader:
+    '''Decompression of a read file in a background thread, yielding fixed-size blocks.'''
+
+    def __init__(self, fi, depth = 4):
+        self.f_in = open_reads(fi)
+        self.blocks = queue.Queue(maxsize = depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target = self.fill, daemon = True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stop.is_set():
+                b = self.f_in.read(BLOCK_SIZE)
+                self.put(b)
+                if not b:
+                    break
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.f_in.close()
+
+    def put(self, b):
+        while not self.stop.is_set(): # Don't block forever if the consumer has gone away
+            try:
+                self.blocks.put(b, timeout = 1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.stop.set()
+
+    def __iter__(self):
+        while True:
+            b = self.blocks.get()
+            if isinstance(b, Exception):
+                raise b
+            if not b:
+                return
+            yield b
+
+
+class Line_Reader:
+    '''Complete lines from a Block_Reader, handed out n at a time.'''
+
+    def __init__(self, fi):
+        self.fi = fi
+        self.reader = Block_Reader(fi)
+        self.blocks = iter(self.reader)
+        self.lines = []
+        self.tail = b''
+        self.eof = False
+
+    def refill(self):
+        b = next(self.blocks, None)
+        if b is None:
+            self.eof = True
+            if self.tail:
+                self.lines.append(self.tail)
+                self.tail = b''
+            return
+        new_lines = (self.tail + b).split(b'\n')
+        self.tail = new_lines.pop()
+        self.lines.extend(new_lines)
+
+    def take(self, n):
+        while len(self.lines) < n and not self.eof:
+            self.refill()
+        out = self.lines[:n]
+        del self.lines[:n]
+        return out
+
+    def close(self):
+        self.reader.close()
+
+
+class Block_Writer:
+    '''Buffered output to a plain file, stdout ('-'), or a gzip file (if fo ends in .gz) 
+    compressed as independent members by a pool of threads.'''
+
+    def __init__(self, fo, threads = 1, level = 6):
+        self.stdout = fo == '-'
+        self.f_out = sys.stdout.buffer if self.stdout else open(fo, 'wb')
+        self.threads = max(1, int(threads))
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers = self.threads) if fo.endswith('.gz') else None
+        self.pending = deque()
+        self.buf = []
+        self.size = 0
+
+    def write(self, b):
+        self.buf.append(b)
+        self.size += len(b)
+        if self.size >= BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            data = b''.join(self.buf)
+            self.buf = []
+            self.size = 0
+            if self.pool:
+                self.pending.append(self.pool.submit(gzip.compress, data, self.level, mtime = 0))
             else:
-                f_out.write(l)
+                self.f_out.write(data)
+        while self.pending and (len(self.pending) > 2 * self.threads or self.pending[0].done()):
+            self.f_out.write(self.pending.popleft().result()) # Members are written in submission order
 
+    def close(self):
+        self.flush()
+        while self.pending:
+            self.f_out.write(self.pending.popleft().result())
+        if self.pool:
+            self.pool.shutdown()
+        if self.stdout:
+            self.f_out.flush()
+        else:
+            self.f_out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-def reformat_row_meta(row, min_abund): 
-    # Reshape into [rank, metaphlan, clade, second_elem, third_elem]
-    clade_lst = row[0].split('|')
-    if 't__' in clade_lst[-1]:
-        return []
-    else:
-        raw_clade = clade_lst[-1] # Pick the lowest clade unless strain present, in which case skip
-    if 'unclassified' in raw_clade:
-        rank = 'u'
-        clade = 'unclassified'
-        tax_id = 'NaN'
-    else:
-        raw_clade_lst = raw_clade.split('__')
-        rank = raw_clade_lst[0]
-        clade = raw_clade_lst[1].replace('_', ' ')
-        tax_id_lst = row[1].split('|')
-        tax_id = tax_id_lst[-2] if rank == 't' else tax_id_lst[-1] # Like the above, pick the lowest clade's taxID
-    rel_abund = row[2] / 100.0 if row[2] >= min_abund * 100.0 else 0
-    return [rank, 'metaphlan', clade, tax_id, rel_abund]
-        # MetaPhlan4 outputs the percentage numerator instead of decimals
+
+# Replace the (optional) caption on line 3 of each record with a bare '+'
+# Output is gzipped if fo ends in .gz, uncompressed otherwise, or streamed to stdout if fo is '-'
+# Also takes a list of FASTQs, which are scrubbed and concatenated into one output in the given order
+def scrub_fastq_captions(fi, fo, threads = 1, level = 1):
+    fis = [fi] if isinstance(fi, str) else fi
+    start = time.time()
+    num_recs = 0
+    with Block_Writer(fo, threads, level) as f_out:
+        for f in fis:
+            reader = Line_Reader(f)
+            try:
+                while True:
+                    lines = reader.take(4 * RECORD_BATCH)
+                    if not lines:
+                        break
+                    if len(lines) % 4:
+                        raise ValueError('{}: truncated FASTQ record at the end of the file'.format(f))
+                    seps = lines[2::4]
+                    if not all(l[:1] == b'+' for l in seps):
+                        raise ValueError('{}: malformed FASTQ record near record {}'.format(f, num_recs))
+                    lines[2::4] = [b'+'] * len(seps)
+                    lines.append(b'')
+                    f_out.write(b'\n'.join(lines))
+                    num_recs += len(seps)
+            finally:
+                reader.close()
+    secs = max(time.time() - start, 1e-9)
+    print('{}: scrubbed {} records in {:.1f} s ({:.0f} records/s)'.format(','.join(fis), num_recs, secs, num_recs / secs), file = sys.stderr)
+    return num_recs
+
+
+# Seeded subsample of the read pairs in fis (fwd, rev), drawn once per pair so that the mates stay matched
+# If n is 1 or more, exactly n pairs are kept by reservoir sampling, otherwise each pair is kept with probability n
+# The seed is combined with the sample name, so each sample's draw is the same however the sample sheet changes
+# Kept pairs are written in their original order; returns the number of pairs read and kept
+def subsample_pairs(fis, fos, n, sample, seed = 0, threads = 1, level = 1):
+    start = time.time()
+    rng = np.random.default_rng([int(seed), int(hashlib.md5(sample.encode()).hexdigest()[:8], 16)])
+    size = int(n) if n >= 1 else 0
+    num_pairs, num_kept = 0, 0
+    slots = [] # Index and records of each kept pair, when reservoir sampling
+    readers = [Line_Reader(f) for f in fis]
+    writers = [Block_Writer(f, threads, level) for f in fos]
+    try:
+        while True:
+            lines = [r.take(4 * RECORD_BATCH) for r in readers]
+            if len(lines[0]) != len(lines[1]) or len(lines[0]) % 4:
+                raise ValueError('{}: mates differ in number of records, or a record is truncated'.format(','.join(fis)))
+            if not lines[0]:
+                break
+            idx = np.arange(num_pairs, num_pairs + len(lines[0]) // 4)
+            u = rng.random(len(idx))
+            if size:
+                pos = np.where(idx < size, idx, (u * (idx + 1)).astype(np.int64)) # Slot that each pair would replace
+                for k in np.flatnonzero(pos < size): # In order, so a later pair displaces an earlier one
+                    recs = [b'\n'.join(l[4 * k:4 * k + 4]) + b'\n' for l in lines]
+                    if idx[k] < size:
+                        slots.append((idx[k], recs))
+                    else:
+                        slots[pos[k]] = (idx[k], recs)
+            else:
+                keep = np.flatnonzero(u < n)
+                for w, l in zip(writers, lines):
+                    w.write(b''.join(b'\n'.join(l[4 * k:4 * k + 4]) + b'\n' for k in keep))
+                num_kept += len(keep)
+            num_pairs += len(idx)
+        if size:
+            slots.sort(key = lambda x: x[0])
+            for i, w in enumerate(writers):
+                w.write(b''.join(recs[i] for _, recs in slots))
+            num_kept = len(slots)
+    finally:
+        for r in readers:
+            r.close()
+        for w in writers:
+            w.close()
+    print('{}: kept {} of {} read pairs in {:.1f} s'.format(sample, num_kept, num_pairs, time.time() - start), file = sys.stderr)
+    return num_pairs, num_kept
+
+
+def reformat_meta(raw_df, sample, min_abund):
+    # Reshape into [rank, metaphlan, clade, tax_id, sample_ra], skipping strains and unclassified clades
+    raw_clade = raw_df.iloc[:, 0].astype(str).str.rsplit('|', n = 1).str[-1] # The lowest clade
+    clade_parts = raw_clade.str.split('__')
+    out_df = pd.DataFrame({ \
+        'rank' : clade_parts.str[0], \
+        'classifier' : 'metaphlan', \
+        'clade' : clade_parts.str[1].str.replace('_', ' ', regex = False), \
+        'tax_id' : raw_df.iloc[:, 1].astype(str).str.rsplit('|', n = 1).str[-1]})
+    rel_abund = pd.to_numeric(raw_df.iloc[:, 2], errors = 'coerce')
+    out_df[sample] = (rel_abund / 100.0).where(rel_abund >= min_abund * 100.0, 0) # MetaPhlan4 outputs the percentage numerator instead of decimals
+    keep = out_df['rank'].isin(list(RANK_CODES)) & ~raw_clade.str.contains('unclassified', regex = False)
+    return out_df[keep]
 
 
 # Process single-sample MetaPhlan reports into single-sample unified format report
 # In:   #clade_name     NCBI_tax_id     relative_abundance      additional_species
 # In:   k__Bacteria|p__Bacteroidetes    2|976   71.60402
 # Out:  classifier,clade,taxid,sample_X_ra
+# Also takes a list of reports so that a batch of samples can be processed in one go
 def standardize_metaphlan(fi, out_dir, min_abund):
-    raw_df = pd.read_csv(fi, sep = '\t', skiprows = 5, header = 0, index_col = None)
-    sample = basename(fi).split('.')[0]
-    out_lst = list(raw_df.apply(lambda row : reformat_row_meta(row, min_abund), axis = 1))
-    basic_cols = ['classifier', 'clade', 'tax_id']
-    out_df = pd.DataFrame(out_lst, columns = ['rank'] + basic_cols + [sample])
-    for r, rank in { 's' : 'species', 'g' : 'genus', 'f' : 'family', 'o' : 'order', 'c' : 'class', 'p' : 'phylum'}.items():
-        sub_df = out_df[out_df.iloc[:,0] == r]
-        if not sub_df.empty:
-            sub_df.drop(columns = sub_df.columns[0], axis = 1, inplace = True) # Get rid of rank column
-        sub_df.to_csv(join(out_dir, sample + '_' + rank + '.csv'), header = True, index = False)
+    for f in ([fi] if isinstance(fi, str) else fi):
+        raw_df = pd.read_csv(f, sep = '\t', skiprows = 5, header = 0, index_col = None)
+        sample = basename(f).split('.')[0]
+        out_df = reformat_meta(raw_df, sample, min_abund)
+        rank_dfs = dict(tuple(out_df.groupby('rank', sort = False)))
+        for r, rank in RANK_CODES.items():
+            sub_df = rank_dfs[r] if r in rank_dfs else out_df.iloc[0:0]
+            sub_df.drop(columns = 'rank').to_csv(join(out_dir, sample + '_' + rank + '.csv'), header = True, index = False)
 
 
 # Process single-sample Bracken reports into single-sample unified format report
 # In: name    taxonomy_id     taxonomy_lvl    kraken_assigned_reads   added_reads new_est_reads   fraction_total_reads
 # Out:  classifier,classification,taxid,sample_1_ra,sample_2_ra,sample_3_ra
+# Also takes a list of reports (ex. all ranks of a sample, or a batch of samples) to process in one go
 def standardize_bracken(fi, out_dir, min_abund):
-    raw_df = pd.read_csv(fi, sep = '\t', header = 0, index_col = None)
-    abs_path = fi.split('/')
-    sample = abs_path[-2]
-    rank = abs_path[-1].split('.')[0]
-    raw_df['classifier'] = 'kraken_bracken'
-    raw_df[sample] = list(raw_df.apply(lambda row : row[6] if row[6] >= min_abund else 0, axis = 1))
-    pruned_df = raw_df[['classifier', 'name', 'taxonomy_id', sample]]
-    pruned_df.columns = ['classifier', 'clade', 'tax_id', sample]
-    pruned_df.to_csv(join(out_dir, sample + '_' + rank + '.csv'), header = True, index = False)
-
-
-def load_taxid(ncbi_taxid):
-    n2i_df = pd.read_csv(ncbi_taxid, sep = "\t|\t", header = None, index_col = None)
-    pruned_df = n2i_df.iloc[:,[0,2]]
-    pruned_df.set_index(2, inplace = True)
-    return {i : row for i, row in pruned_df.iterrows()} # This takes a long time
-
-
-def reformat_row_xtree(row, n2i_dct, r):
-    # Reshape into [rank, xtree, clade, sample_1_ra,...,sample_n_ra]
-    raw_clade = 'NaN'
-    for c in row[0].split(';'):
-        if r + '__' in c:
-            raw_clade = c
-    if raw_clade == 'NaN':
-        return
-    raw_clade_lst = raw_clade.split('__')
-    clade = raw_clade_lst[1].replace('_', ' ')
-    clade_name_parts = clade.split()
-    if len(clade_name_parts[-1]) == 1 and clade_name_parts[-1].isupper(): # Delete non-canonical information from taxon name
-        clade = clade[:-2]
-    tax_id = n2i_dct[clade][0] if clade in n2i_dct else 'NaN'
-    new_row = ['xtree', clade, tax_id]
-    new_row.extend(row[1:])
-    return new_row
+    for f in ([fi] if isinstance(fi, str) else fi):
+        raw_df = pd.read_csv(f, sep = '\t', header = 0, index_col = None)
+        abs_path = f.split('/')
+        sample = abs_path[-2]
+        rank = abs_path[-1].split('.')[0]
+        frac = raw_df['fraction_total_reads']
+        out_df = pd.DataFrame({ \
+            'classifier' : 'kraken_bracken', \
+            'clade' : raw_df['name'], \
+            'tax_id' : raw_df['taxonomy_id'], \
+            sample : frac.where(frac >= min_abund, 0)})
+        out_df.to_csv(join(out_dir, sample + '_' + rank + '.csv'), header = True, index = False)
+
+
+BRACKEN_LEVELS = ['S', 'G', 'F', 'O', 'C', 'P']
+
+
+# Index a Bracken databaseXmers.kmer_distrib (mapped taxid, then genome:mapped k-mers:total k-mers for each genome) 
+# into arrays of the fraction of each genome's reads that Kraken2 classifies to each taxid
+def build_kmer_index(kmer_distrib, index):
+    st = os.stat(kmer_distrib)
+    mapped, lengths, genomes, fracs = [], [], [], []
+    with open(kmer_distrib, 'r') as f_in:
+        next(f_in) # Header
+        for l in f_in:
+            taxid, dist = l.rstrip('\n').split('\t')
+            vals = np.array(dist.replace(':', ' ').split(), dtype = np.float64).reshape(-1, 3)
+            mapped.append(int(taxid))
+            lengths.append(len(vals))
+            genomes.append(vals[:, 0].astype(np.int64))
+            fracs.append(vals[:, 1] / vals[:, 2])
+    # Sorted by mapped taxid for lookups, and as when read into a dictionary, the last line for a taxid wins
+    mapped = np.array(mapped, dtype = np.int64)
+    order = np.arange(len(mapped))
+    _, last = np.unique(mapped[::-1], return_index = True)
+    order = order[::-1][last]
+    genome_ids, genome_cols = np.unique(np.concatenate(genomes) if genomes else np.array([], dtype = np.int64), \
+                                        return_inverse = True)
+    starts = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    cols = [genome_cols[starts[i]:starts[i + 1]] for i in order]
+    indptr = np.concatenate([[0], np.cumsum([len(c) for c in cols])]).astype(np.int64)
+    tmp_index = index + '.tmp'
+    with open(tmp_index, 'wb') as f_out:
+        np.savez(f_out, mapped = mapped[order], indptr = indptr, \
+                 cols = np.concatenate(cols) if cols else np.array([], dtype = np.int64), \
+                 fracs = np.concatenate([fracs[i] for i in order]) if cols else np.array([], dtype = np.float64), \
+                 genomes = genome_ids, meta = np.array([abspath(kmer_distrib), str(st.st_size), str(st.st_mtime_ns), fast_hash(kmer_distrib)]))
+    os.replace(tmp_index, index)
+
+
+def kmer_index_current(kmer_distrib, index):
+    if not exists(index):
+        return False
+    try:
+        with np.load(index) as npz:
+            meta = npz['meta'].tolist()
+    except (OSError, ValueError, KeyError):
+        return False
+    return file_unchanged(kmer_distrib, meta[1], meta[2], meta[3])
+
+
+def load_kmer_index(kmer_distrib, index = None):
+    # Sparse mapped taxid x genome matrix of fractions, with the row and column taxids
+    index = index if index else kmer_distrib + '.npz'
+    if not kmer_index_current(kmer_distrib, index): # Rebuild if the k-mer distribution has been updated since indexing
+        build_kmer_index(kmer_distrib, index)
+    with np.load(index) as npz:
+        mat = sparse.csr_matrix((npz['fracs'], npz['cols'], npz['indptr']), shape = (len(npz['mapped']), len(npz['genomes'])))
+        return mat, npz['mapped'], npz['genomes']
+
+
+def read_kreport(fi):
+    # Classified taxa of a Kraken2 report (with or without minimizer columns), with each one's parent
+    df = pd.read_csv(fi, sep = '\t', header = None, dtype = str, keep_default_na = False, quoting = csv.QUOTE_NONE)
+    df = df[pd.to_numeric(df.iloc[:, 1], errors = 'coerce').notna() & (df.iloc[:, -3] != 'U')].reset_index(drop = True)
+    raw_names = df.iloc[:, -1]
+    names = raw_names.str.lstrip(' ')
+    depth = ((raw_names.str.len() - names.str.len()) // 2).to_numpy()
+    parent = np.full(len(df), -1, dtype = np.int64)
+    pos = np.arange(len(df))
+    for d in np.unique(depth[depth > 0]):
+        cand, idx = pos[depth == d - 1], pos[depth == d]
+        k = np.searchsorted(cand, idx) - 1 # Closest preceding taxon one level up
+        parent[idx] = np.where(k >= 0, cand[np.maximum(k, 0)], -1)
+    return pd.DataFrame({'name' : names, 'taxid' : df.iloc[:, -2].astype(np.int64), 'code' : df.iloc[:, -3], \
+                         'all_reads' : df.iloc[:, 1].astype(np.int64), 'lvl_reads' : df.iloc[:, 2].astype(np.int64), \
+                         'depth' : depth, 'parent' : parent})
+
+
+# Re-estimate a Kraken2 report's abundances at every level in BRACKEN_LEVELS in one go, as Bracken's est_abundance.py does:
+# reads Kraken2 left on a taxon above the level are split between the level's taxa below it in proportion to 
+# (fraction of each genome's reads expected at that taxon) x (reads Kraken2 assigned to the genome)
+# Taxa at the level with fewer than thresh reads are dropped, and the rest (and the taxa below them) keep their reads
+# Out: one table per level, in bracken's format
+def estimate_abundance(kreport, kmer_index, thresh = 10):
+    mat, mapped, genomes = kmer_index
+    rep = read_kreport(kreport)
+    n = len(rep)
+    all_reads, lvl_reads = rep['all_reads'].to_numpy(), rep['lvl_reads'].to_numpy()
+    parent = rep['parent'].to_numpy()
+    is_level = rep['code'].to_numpy()[:, None] == np.array(BRACKEN_LEVELS)[None, :]
+
+    # Closest ancestor (or self) at each level, filled in from the root down
+    anc = np.full((n, len(BRACKEN_LEVELS)), -1, dtype = np.int64)
+    depth = rep['depth'].to_numpy()
+    for d in np.unique(depth):
+        idx = np.flatnonzero(depth == d)
+        up = np.where(parent[idx, None] >= 0, anc[np.maximum(parent[idx], 0)], -1)
+        anc[idx] = np.where(is_level[idx], idx[:, None], up)
+    kept = is_level & (all_reads >= thresh)[:, None]
+    target = np.where((anc >= 0) & kept[np.maximum(anc, 0), np.arange(len(BRACKEN_LEVELS))], anc, -1)
+
+    # Genomes of the k-mer distribution found in the report, and the rows of taxa in the report
+    order = np.argsort(rep['taxid'].to_numpy(), kind = 'stable')
+    sorted_ids = rep['taxid'].to_numpy()[order]
+    k = np.minimum(np.searchsorted(sorted_ids, genomes), max(n - 1, 0))
+    gnode = np.where((n > 0) & (sorted_ids[k] == genomes), order[k], -1) if n else np.full(len(genomes), -1)
+    r = np.minimum(np.searchsorted(mapped, rep['taxid'].to_numpy()), max(len(mapped) - 1, 0))
+    in_distrib = (mapped[r] == rep['taxid'].to_numpy()) if len(mapped) else np.zeros(n, dtype = bool)
+
+    out = {}
+    for j, code in enumerate(BRACKEN_LEVELS):
+        src = np.flatnonzero((anc[:, j] < 0) & (lvl_reads > 0) & in_distrib)
+        g = np.flatnonzero(gnode >= 0)
+        g = g[target[gnode[g], j] >= 0]
+        genome_reads = sparse.csr_matrix((lvl_reads[gnode[g]].astype(np.float64), (g, target[gnode[g], j])), \
+                                         shape = (len(genomes), n))
+        weights = mat[r[src]] @ genome_reads
+        tot = np.asarray(weights.sum(axis = 1)).ravel()
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            share = np.where(tot > 0, lvl_reads[src] / tot, 0)
+        added = np.asarray((sparse.diags(share) @ weights).sum(axis = 0)).ravel()
+        rows = np.flatnonzero(kept[:, j])
+        new_all = all_reads[rows] + added[rows]
+        out[RANK_CODES[code.lower()]] = pd.DataFrame({ \
+            'name' : rep['name'].to_numpy()[rows], \
+            'taxonomy_id' : rep['taxid'].to_numpy()[rows], \
+            'taxonomy_lvl' : code, \
+            'kraken_assigned_reads' : all_reads[rows], \
+            'added_reads' : new_all.astype(np.int64) - all_reads[rows], \
+            'new_est_reads' : new_all.astype(np.int64), \
+            'fraction_total_reads' : ['%0.5f' % f for f in new_all / new_all.sum()] if len(rows) else []})
+    return out
+
+
+# Write the six rank tables of estimate_abundance() for a sample as out_dir/{rank}.tsv
+def bracken_native(kreport, kmer_distrib, out_dir, index = None, thresh = 10):
+    for rank, df in estimate_abundance(kreport, load_kmer_index(kmer_distrib, index), thresh).items():
+        df.to_csv(join(out_dir, rank + '.tsv'), sep = '\t', header = True, index = False)
+
+
+# Differences between estimate_abundance() and the bracken CLI's tables for the same report, at all six ranks
+# expected_dir holds the CLI's {rank}.tsv (ex. 2_kraken2/raw_bracken/{sample} of a run with bracken_engine: 'cli')
+# Out: rank, taxonomy_id, column, expected, observed for every taxon missing from either side or estimated differently
+def compare_bracken(kreport, kmer_distrib, expected_dir, thresh = 10, tolerance = 1e-5):
+    with tempfile.TemporaryDirectory() as d: # Keep the k-mer index out of the database (or fixture) directory
+        est = estimate_abundance(kreport, load_kmer_index(kmer_distrib, join(d, 'kmer_distrib.npz')), thresh)
+    diffs = []
+    for rank in RANK_CODES.values():
+        exp = pd.read_csv(join(expected_dir, rank + '.tsv'), sep = '\t', header = 0)
+        both = exp.merge(est[rank], on = 'taxonomy_id', how = 'outer', suffixes = ('_exp', '_obs'), indicator = True)
+        for _, r in both.iterrows():
+            if r['_merge'] != 'both':
+                diffs.append([rank, r['taxonomy_id'], 'taxon', r['_merge'] != 'right_only', r['_merge'] != 'left_only'])
+                continue
+            for c in ['kraken_assigned_reads', 'added_reads', 'new_est_reads']:
+                if int(r[c + '_exp']) != int(r[c + '_obs']):
+                    diffs.append([rank, r['taxonomy_id'], c, r[c + '_exp'], r[c + '_obs']])
+            if abs(float(r['fraction_total_reads_exp']) - float(r['fraction_total_reads_obs'])) > tolerance:
+                diffs.append([rank, r['taxonomy_id'], 'fraction_total_reads', r['fraction_total_reads_exp'], r['fraction_total_reads_obs']])
+    return pd.DataFrame(diffs, columns = ['rank', 'taxonomy_id', 'column', 'expected', 'observed'])
+
+
+def read_xtree_cov(fi):
+    # Proportion and unique proportion of each reference covered, with names trimmed at the first space
+    df = pd.read_csv(fi, sep = '\t', header = 0, index_col = 0)
+    names = df.index.astype(str).str.split(' ', n = 1).str[0]
+    keep = ~names.duplicated(keep = 'last') # As when assigning into a table by name, the last duplicate wins
+    return names[keep].to_numpy(), df['Proportion_covered'].to_numpy(dtype = float)[keep], \
+        df['Unique_proportion_covered'].to_numpy(dtype = float)[keep]
+
+
+def read_xtree_ref(fi):
+    # Reads assigned to each reference
+    try:
+        df = pd.read_csv(fi, sep = '\t', header = None, index_col = 0)
+    except pd.errors.EmptyDataError: # No reads were assigned
+        return np.array([], dtype = object), np.array([], dtype = float)
+    names = df.index.astype(str).str.split(' ', n = 1).str[0]
+    keep = ~names.duplicated(keep = 'last')
+    return names[keep].to_numpy(), df.iloc[:, 0].to_numpy(dtype = float)[keep]
+
+
+def xtree_matrices(tables):
+    # Stack per-sample (names, values...) tables into sparse reference x sample matrices
+    # Rows are the union of references in order of first appearance, columns the samples in order
+    index = {}
+    rows, cols = [], []
+    vals = [[] for _ in tables[0][1:]] if tables else []
+    for j, (names, *v) in enumerate(tables):
+        rows.append(np.fromiter((index.setdefault(n, len(index)) for n in names), dtype = np.int64, count = len(names)))
+        cols.append(np.full(len(names), j, dtype = np.int64))
+        for k, a in enumerate(v):
+            vals[k].append(a)
+    shape = (len(index), len(tables))
+    r = np.concatenate(rows) if rows else np.array([], dtype = np.int64)
+    c = np.concatenate(cols) if cols else np.array([], dtype = np.int64)
+    return list(index), [sparse.csr_matrix((np.concatenate(v), (r, c)), shape = shape) for v in vals]
+
+
+def make_unique(names):
+    # R's make.unique(): repeats of a name get .1, .2, ... appended, skipping names that are already taken
+    names = pd.Series(names, dtype = object).reset_index(drop = True)
+    dups = names.duplicated()
+    if not dups.any():
+        return names.tolist()
+    taken = set(names)
+    counter = {}
+    for i in np.flatnonzero(dups.to_numpy()):
+        n = names[i]
+        k = counter.get(n, 0)
+        while True:
+            k += 1
+            new = '{}.{}'.format(n, k)
+            if new not in taken:
+                break
+        counter[n] = k
+        taken.add(new)
+        names[i] = new
+    return names.tolist()
+
+
+def r_num(x):
+    # Numbers as R's write.table prints them (15 significant digits)
+    return '%.15g' % x if x == x else 'NaN'
+
+
+def write_xtree_table(names, mat, samples, fo, fill = None):
+    # Tab-separated with a header of sample names only, like R's write.table
+    # Only the non-zero cells of each row need formatting; the rest take the column's fill value
+    mat = mat.tocsr()
+    indptr, indices, data = mat.indptr, mat.indices, mat.data.tolist()
+    fill = fill if fill is not None else ['0'] * len(samples)
+    with open(fo, 'w') as f_out:
+        f_out.write('\t'.join(samples) + '\n')
+        for i, n in enumerate(names):
+            row = fill.copy()
+            for j in range(indptr[i], indptr[i + 1]):
+                row[indices[j]] = r_num(data[j])
+            f_out.write('\t'.join([n] + row) + '\n')
+
+
+def normalize_columns(mat):
+    # Divide each column by its sum; columns summing to zero are all NaN, as in R
+    sums = np.asarray(mat.sum(axis = 0)).ravel()
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        scale = np.where(sums != 0, 1.0 / sums, 0)
+    fill = ['NaN' if t == 0 else '0' for t in sums]
+    mat = sparse.csr_matrix(mat @ sparse.diags(scale))
+    mat.eliminate_zeros()
+    return mat, fill
+
+
+# Reader outputs for each file, only parsing the files that are new or changed since they were cached
+def read_xtree_cached(fis, reader, cache, threads = 1):
+    store = Merge_Cache(cache, 1)
+    tables = [None] * len(fis)
+    if cache:
+        names = np.array([k[0] for k in store.keys], dtype = object)
+        for i, f in enumerate(fis):
+            col = store.lookup(f)
+            if col is not None:
+                tables[i] = (names[col[1]], *col[2])
+    todo = [i for i, t in enumerate(tables) if t is None]
+    with ThreadPoolExecutor(max_workers = max(threads, 1)) as pool:
+        for i, t in zip(todo, pool.map(reader, [fis[i] for i in todo])):
+            tables[i] = t
+            if cache:
+                store.store(fis[i], '', store.key_ids((n,) for n in t[0]), np.vstack(t[1:]))
+    if cache:
+        store.save(fis)
+    return tables
+
+
+# Merge XTree's per-sample coverage (.cov) and read assignment (.ref) files into reference x sample tables
+# A reference's reads in a sample are masked (moved to Unknown) if (unique coverage <= uthresh or coverage <= thresh) 
+# and coverage <= hthresh, and references without reads left are dropped
+# Out: {group}_counts, _counts_raw (unmasked counts of the same references, without Unknown), _ra, _ra_raw, 
+#      _coverages, _unique_coverages
+# With a cache prefix, parsed .cov and .ref files are kept in {cache}.cov.npz and {cache}.ref.npz,
+# so only new or changed samples are parsed when the cohort grows
+def merge_xtree(cov_fis, out_dir, group, thresh, hthresh, uthresh, mappings, threads = 1, cache = None):
+    ref_fis = [re.sub(r'\.cov$', '.ref', f) for f in cov_fis]
+    covs = read_xtree_cached(cov_fis, read_xtree_cov, cache + '.cov.npz' if cache else None, threads)
+    refs = read_xtree_cached(ref_fis, read_xtree_ref, cache + '.ref.npz' if cache else None, threads)
+    cov_samples = [re.sub(r'.cov.*', '', basename(f)) for f in cov_fis]
+    ref_samples = [re.sub(r'.ref.*', '', basename(f)) for f in ref_fis]
+    genomes, (cov, cov_u) = xtree_matrices(covs)
+    ref_genomes, (otus, ) = xtree_matrices(refs)
+    del covs, refs
+
+    # Look up each read assignment's coverages and mask it
+    otus = otus.tocoo()
+    g = pd.Index(genomes).get_indexer(ref_genomes)[otus.row]
+    j = pd.Index(cov_samples).get_indexer(ref_samples)[otus.col]
+    found = (g >= 0) & (j >= 0)
+    c, u = np.zeros(otus.nnz), np.zeros(otus.nnz)
+    c[found] = np.asarray(cov[g[found], j[found]]).ravel()
+    u[found] = np.asarray(cov_u[g[found], j[found]]).ravel()
+    masked = ((u <= uthresh) | (c <= thresh)) & (c <= hthresh)
+    counts = sparse.csr_matrix((np.where(masked, 0, otus.data), (otus.row, otus.col)), shape = otus.shape)
+    otus = otus.tocsr()
+
+    # Keep references with coverage data and reads left after masking, then account for the rest as Unknown
+    keep = np.flatnonzero((pd.Index(genomes).get_indexer(ref_genomes) >= 0) & (np.asarray(counts.sum(axis = 1)).ravel() > 0))
+    tkey = pd.read_csv(mappings, sep = '\t', header = None, index_col = 0, usecols = [0, 1], \
+                       quoting = csv.QUOTE_NONE, dtype = str).iloc[:, 0]
+    tkey = tkey[~tkey.index.duplicated()]
+    taxa = make_unique(tkey.reindex(ref_genomes).fillna('NA'))
+    names = [taxa[i] for i in keep]
+    counts, counts_raw = counts[keep], otus[keep]
+    unknown = np.asarray(otus.sum(axis = 0)).ravel() - np.asarray(counts.sum(axis = 0)).ravel()
+    counts = sparse.vstack([counts, sparse.csr_matrix(unknown)], format = 'csr')
+
+    prefix = join(out_dir, group)
+    write_xtree_table(names + ['Unknown'], counts, ref_samples, prefix + '_counts.tsv')
+    write_xtree_table(names, counts_raw, ref_samples, prefix + '_counts_raw.tsv')
+    ra, fill = normalize_columns(counts)
+    write_xtree_table(names + ['Unknown'], ra, ref_samples, prefix + '_ra.tsv', fill)
+    ra_raw, fill = normalize_columns(counts_raw)
+    write_xtree_table(names, ra_raw, ref_samples, prefix + '_ra_raw.tsv', fill)
+    write_xtree_table(genomes, cov, cov_samples, prefix + '_coverages.tsv')
+    write_xtree_table(genomes, cov_u, cov_samples, prefix + '_unique_coverages.tsv')
+
+
+# Index names.dmp (taxid | name | unique name | name class) into an SQLite table keyed by name
+# As in a dictionary built from the file, later lines win when names are repeated
+def build_taxid_index(ncbi_taxid, index):
+    tmp_index = index + '.tmp'
+    if exists(tmp_index):
+        os.remove(tmp_index)
+    st = os.stat(ncbi_taxid)
+    conn = sqlite3.connect(tmp_index)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE names (name TEXT PRIMARY KEY, taxid INTEGER) WITHOUT ROWID')
+    with open(ncbi_taxid, 'r') as f_in:
+        rows = (l.split('\t|\t') for l in f_in)
+        conn.executemany('INSERT OR REPLACE INTO names VALUES (?, ?)', ((r[1], int(r[0])) for r in rows if len(r) > 1))
+    conn.executemany('INSERT INTO meta VALUES (?, ?)', [('source', abspath(ncbi_taxid)), ('size', str(st.st_size)), \
+        ('mtime_ns', str(st.st_mtime_ns)), ('hash', fast_hash(ncbi_taxid))])
+    conn.commit()
+    conn.close()
+    os.replace(tmp_index, index)
+
+
+def taxid_index_current(ncbi_taxid, index):
+    if not exists(index):
+        return False
+    try:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(index), uri = True)
+        meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+        conn.close()
+    except sqlite3.Error:
+        return False
+    return file_unchanged(ncbi_taxid, meta.get('size'), meta.get('mtime_ns'), meta.get('hash'))
+
+
+class Taxid_Index:
+    '''Read-only lookups of NCBI taxonomic IDs by name.'''
+
+    def __init__(self, index):
+        self.conn = sqlite3.connect('file:{}?mode=ro'.format(index), uri = True, check_same_thread = False)
+
+    def get(self, name, default = None):
+        row = self.conn.execute('SELECT taxid FROM names WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        taxid = self.get(name)
+        if taxid is None:
+            raise KeyError(name)
+        return taxid
+
+    def lookup(self, names, chunk = 900): # SQLite's default limit on bound parameters is 999
+        # Vectorized lookup of a column of names, returning a Series of integer taxids (<NA> if missing)
+        names = pd.Series(names)
+        uniq = [n for n in names.dropna().unique()]
+        found = {}
+        for i in range(0, len(uniq), chunk):
+            sub = uniq[i:i + chunk]
+            q = 'SELECT name, taxid FROM names WHERE name IN ({})'.format(','.join(['?'] * len(sub)))
+            found.update(self.conn.execute(q, sub).fetchall())
+        return names.map(found).astype('Int64')
+
+    def close(self):
+        self.conn.close()
+
+
+def load_taxid(ncbi_taxid, index = None):
+    index = index if index else ncbi_taxid + '.sqlite'
+    if not taxid_index_current(ncbi_taxid, index): # Rebuild if the taxonomy dump has been updated since indexing
+        build_taxid_index(ncbi_taxid, index)
+    return Taxid_Index(index)
+
+
+def parse_lineages(lineages):
+    # Split ;-joined lineages once, and pull out the cleaned clade name at every rank as a (lineage x rank) table
+    comps = lineages.astype(str).str.split(';', expand = True)
+    clades = {}
+    for r in RANK_CODES:
+        hits = comps.where(comps.apply(lambda c : c.str.contains(r + '__', regex = False, na = False)))
+        raw_clade = hits.ffill(axis = 1).iloc[:, -1] # The last component at the rank, as in the lineage
+        clade = raw_clade.str.split('__').str[1].str.replace('_', ' ', regex = False)
+        clade = clade.str.replace(r'\s[A-Z]$', '', regex = True) # Delete non-canonical information from taxon name
+        clades[r] = clade.where(clade.str.len() > 0)
+    return pd.DataFrame(clades)
 
 
 # Process merged XTree reports into merged unified format report
 # In: NA    Xsample_1        Xsample_2        Xsample_3
 # Out:  classifier,classification,taxid,sample_1_ra,sample_2_ra,sample_3_ra
-def standardize_xtree(fi, out_dir, ncbi_taxid, uthresh):
-    n2i_dct = load_taxid(ncbi_taxid)
+def standardize_xtree(fi, out_dir, ncbi_taxid, uthresh, index = None):
+    n2i = load_taxid(ncbi_taxid, index)
     raw_df = pd.read_csv(fi, sep = '\t', header = 0, index_col = None)
     raw_df.reset_index(inplace = True)
-    basic_cols = ['classifier', 'clade', 'tax_id']
     sample_names = list(raw_df.columns[1:])
-    column_names = basic_cols + sample_names # 1 | all)
-    for r, rank in { 's' : 'species', 'g' : 'genus', 'f' : 'family', 'o' : 'order', 'c' : 'class', 'p' : 'phylum'}.items():
-        out_lst = list(raw_df.apply(lambda row : reformat_row_xtree(row, n2i_dct, r), axis = 1))
-        filt_lst = [x for x in out_lst if x is not None]
-        filt_df = pd.DataFrame(filt_lst, columns = column_names)
-        filt_df.columns = column_names
-        agg_dct = {}
-        for c in basic_cols:
-            agg_dct[c] = 'first'
-        for c in sample_names:
-            agg_dct[c] = 'sum'
-        out_df = filt_df.groupby(filt_df['clade']).aggregate(agg_dct)
-        out_df.reset_index(inplace = True, drop = True)
-        out_df.mask(out_df[sample_names] < uthresh, inplace = True)
-        out_df.dropna(axis = 0, how = 'all', subset = sample_names, inplace = True)
-        for s in sample_names:
-            out_df[s] = out_df[s].fillna(0)
+    clades = parse_lineages(raw_df.iloc[:, 0])
+    mat = np.nan_to_num(raw_df[sample_names].to_numpy(dtype = float), copy = False)
+    del raw_df
+
+    # Assign every (rank, clade) pair its group, then sum all ranks' groups in one sparse product
+    long_df = clades.melt(ignore_index = False, var_name = 'rank', value_name = 'clade').dropna()
+    codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([long_df['rank'], long_df['clade']]))
+    grouping = sparse.csr_matrix((np.ones(len(codes)), (codes, long_df.index.to_numpy())), \
+        shape = (len(uniques), mat.shape[0]))
+    sums = grouping @ mat
+    groups = pd.DataFrame({'rank' : uniques.get_level_values(0), 'clade' : uniques.get_level_values(1)})
+    groups['tax_id'] = n2i.lookup(groups['clade']).astype('string').fillna('NaN')
+    n2i.close()
+
+    for r, rank in RANK_CODES.items():
+        rows = groups.index[groups['rank'] == r]
+        rows = rows[np.argsort(groups.loc[rows, 'clade'].to_numpy(), kind = 'stable')]
+        vals = sums[rows]
+        keep = (vals >= uthresh).any(axis = 1)
+        vals = np.where(vals < uthresh, 0, vals)[keep]
+        out_df = pd.DataFrame(vals, columns = sample_names)
+        out_df.insert(0, 'tax_id', groups.loc[rows[keep], 'tax_id'].to_numpy())
+        out_df.insert(0, 'clade', groups.loc[rows[keep], 'clade'].to_numpy())
+        out_df.insert(0, 'classifier', 'xtree')
         out_df.to_csv(join(out_dir, 'xtree_' + rank + '.csv'), header = True, index = False)
 
 
-def concat_tbls(sample_lst, fo):
-    s_lst = []
-    tmp_colnames = []
-    sample_names = []
-    if len(sample_lst) == 1:
-        shutil.copy(sample_lst[0], fo)
-    else:
-        for i,s in enumerate(sample_lst):
-            df = pd.read_csv(s, header = 0)
-            s_lst.append(df)
-            sample = df.columns[-1]
-            sample_names.append(sample)
-            if i < len(sample_lst) - 1:
-                tmp_colnames.extend(['tmp', 'tmp', 'tmp', sample])
-            else:
-                tmp_colnames.extend(df.columns)
-        df = pd.concat(s_lst, axis = 1, join = 'outer')
-        df.columns = tmp_colnames
-        df.drop(columns = 'tmp', axis = 1, inplace = True) # Get rid of all but the last set of 'classifier, clade, tax_id'
-        df = df[['classifier', 'clade', 'tax_id'] + sample_names]
-        df.fillna(0)
-        df.to_csv(fo, header = True, index = False)
-
-
-def extract_unclassified_names(fi, fo):
-    df = pd.read_csv(fi, sep = '\t', header = None, index_col = None)
-    unc_reads = list(df[df[0] == 'U'][1])
+BASIC_COLS = ['classifier', 'clade', 'tax_id']
+
+
+class Merge_Cache:
+    '''Per-sample columns of a merged table, kept between runs and keyed by each source file's size and mtime.'''
+
+    def __init__(self, path, width):
+        self.path = path
+        self.width = width # Number of fields in a row key
+        self.keys = {} # Row key -> id
+        self.columns = {} # Source file -> (size, mtime_ns, hash, name, key ids, values)
+        if path and exists(path):
+            try:
+                self.load()
+            except (OSError, ValueError, KeyError): # Unreadable caches are rebuilt from scratch
+                self.keys, self.columns = {}, {}
+
+    def load(self):
+        with np.load(self.path, allow_pickle = False) as npz:
+            fields = [npz['key_' + str(k)].tolist() for k in range(self.width)]
+            self.keys = {k : i for i, k in enumerate(zip(*fields))}
+            ptr, ids = npz['ptr'], npz['ids']
+            vals = npz['vals']
+            for j, (src, size, mtime_ns, hsh, name) in enumerate(npz['meta'].tolist()):
+                s = slice(ptr[j], ptr[j + 1])
+                self.columns[src] = (size, mtime_ns, hsh, name, ids[s], vals[:, s])
+
+    def key_ids(self, keys):
+        return np.fromiter((self.keys.setdefault(k, len(self.keys)) for k in keys), dtype = np.int64)
+
+    def lookup(self, fi):
+        # (name, key ids, values) cached for the file, if it has not been rewritten since
+        # Unlike for staged reads, a new mtime is never let through on a matching fast_hash, since a re-run 
+        # report can differ from the cached one only in the middle
+        col = self.columns.get(abspath(fi))
+        try:
+            st = os.stat(fi)
+        except OSError:
+            return None
+        if col is None or str(st.st_size) != col[0] or str(st.st_mtime_ns) != col[1]:
+            return None
+        return col[3:]
+
+    def store(self, fi, name, ids, vals):
+        st = os.stat(fi)
+        vals = np.atleast_2d(np.asarray(vals, dtype = float))
+        self.columns[abspath(fi)] = (str(st.st_size), str(st.st_mtime_ns), fast_hash(fi), name, ids, vals)
+
+    def save(self, keep):
+        # Write out the columns of the files in keep, dropping row keys no longer used by any of them
+        keep = [abspath(f) for f in keep if abspath(f) in self.columns]
+        cols = [self.columns[f] for f in keep]
+        ids = np.concatenate([c[4] for c in cols]) if cols else np.array([], dtype = np.int64)
+        used = np.unique(ids)
+        remap = np.zeros(len(self.keys), dtype = np.int64)
+        remap[used] = np.arange(len(used))
+        key_lst = list(self.keys)
+        fields = list(zip(*[key_lst[i] for i in used])) if len(used) else [()] * self.width
+        arrays = {'key_' + str(k) : np.array(fields[k], dtype = str) for k in range(self.width)}
+        arrays['ids'] = remap[ids]
+        arrays['ptr'] = np.cumsum([0] + [len(c[4]) for c in cols])
+        arrays['vals'] = np.concatenate([c[5] for c in cols], axis = 1) if cols else np.zeros((1, 0))
+        arrays['meta'] = np.array([[f, *c[:4]] for f, c in zip(keep, cols)], dtype = str).reshape(-1, 5)
+        os.makedirs(dirname(self.path) or '.', exist_ok = True)
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self.path)
+
+
+def read_standardized(fi, cache, chunksize = 100000):
+    # Sample name, row key ids, and abundances (zeros kept, so the taxon still gets a row) of a unified format report
+    name, ids, vals = None, [], []
+    for chunk in pd.read_csv(fi, header = 0, dtype = {c : str for c in BASIC_COLS}, keep_default_na = False, \
+                             chunksize = chunksize):
+        name = chunk.columns[-1]
+        ids.append(cache.key_ids(zip(chunk['classifier'], chunk['clade'], chunk['tax_id'])))
+        vals.append(pd.to_numeric(chunk.iloc[:, -1], errors = 'coerce').fillna(0).to_numpy(dtype = float))
+    if name is None: # Empty report
+        return pd.read_csv(fi, header = 0, nrows = 0).columns[-1], np.array([], dtype = np.int64), np.array([])
+    return name, np.concatenate(ids), np.concatenate(vals)
+
+
+# Outer-join single-sample unified format reports on (classifier, clade, tax_id) into a taxon x sample report
+# Files are streamed in chunks into a sparse matrix, so memory scales with the non-zero abundances, 
+# and the merged report is written out a taxon at a time
+# With a cache, only reports that are new or changed since the last merge are read; the rest of the columns 
+# come from the cache, and columns of samples no longer in the list are dropped from it
+def merge_tables(sample_lst, fo, chunksize = 100000, cache = None):
+    store = Merge_Cache(cache, len(BASIC_COLS))
+    cols = []
+    for f in sample_lst:
+        col = store.lookup(f) if cache else None
+        if col is None:
+            name, ids, vals = read_standardized(f, store, chunksize)
+            col = (name, ids, vals.reshape(1, -1))
+            if cache:
+                store.store(f, *col)
+        cols.append(col)
+
+    # Rows in order of first appearance, as when reading the reports in turn
+    ids = np.concatenate([c[1] for c in cols]) if cols else np.array([], dtype = np.int64)
+    used, first = np.unique(ids, return_index = True)
+    order = used[np.argsort(first, kind = 'stable')]
+    remap = np.zeros(len(store.keys), dtype = np.int64)
+    remap[order] = np.arange(len(order))
+    col_idx = np.repeat(np.arange(len(cols)), [len(c[1]) for c in cols])
+    vals = np.concatenate([c[2][0] for c in cols]) if cols else np.array([])
+    nz = vals != 0
+    mat = sparse.coo_matrix((vals[nz], (remap[ids][nz], col_idx[nz])), \
+        shape = (len(order), len(cols))).tocsr() # Duplicated taxa within a sample are summed
+    key_lst = list(store.keys)
+    write_merged([key_lst[i] for i in order], mat, [c[0] for c in cols], fo)
+    if cache:
+        store.save(sample_lst)
+
+
+def write_merged(keys, mat, sample_names, fo):
+    # Only the non-zero cells of each taxon's row need formatting
+    mat = mat.tocsr()
+    indptr, indices, data = mat.indptr, mat.indices, mat.data.tolist()
+    zeros = ['0.0'] * len(sample_names)
     with open(fo, 'w') as f_out:
-        for r in unc_reads:
-            f_out.write(r + '\n')
+        f_out.write(','.join(csv_field(c) for c in BASIC_COLS + sample_names) + '\n')
+        for i, k in enumerate(keys):
+            row = zeros.copy()
+            for j in range(indptr[i], indptr[i + 1]):
+                row[indices[j]] = repr(data[j])
+            f_out.write(','.join([csv_field(c) for c in k] + row) + '\n')
+
+
+def csv_field(f):
+    # Quote a text field the way pandas and the csv module would
+    if any(c in f for c in ',"\n\r'):
+        return '"' + f.replace('"', '""') + '"'
+    return f
+
+
+# Read a merged report in chunks into its classifier, (clade, tax_id) row keys, taxon x sample sparse matrix, and samples
+def read_report_matrix(fi, chunksize = 10000):
+    samples = list(pd.read_csv(fi, header = 0, nrows = 0).columns[len(BASIC_COLS):])
+    classifier = None
+    index = {}
+    rows, cols, vals = [], [], []
+    for chunk in pd.read_csv(fi, header = 0, dtype = {c : str for c in BASIC_COLS}, keep_default_na = False, \
+                             chunksize = chunksize):
+        classifier = classifier if classifier or not len(chunk) else chunk['classifier'].iloc[0]
+        idx = np.fromiter((index.setdefault(k, len(index)) for k in zip(chunk['clade'], chunk['tax_id'])), \
+                          dtype = np.int64, count = len(chunk))
+        m = sparse.coo_matrix(chunk[samples].apply(pd.to_numeric, errors = 'coerce').fillna(0).to_numpy(dtype = float))
+        rows.append(idx[m.row])
+        cols.append(m.col)
+        vals.append(m.data)
+    classifier = classifier if classifier else basename(fi).rsplit('_', 1)[0] # No taxa
+    mat = sparse.csc_matrix((np.concatenate(vals) if vals else [], (np.concatenate(rows) if rows else [], \
+        np.concatenate(cols) if cols else [])), shape = (len(index), len(samples)))
+    return classifier, list(index), mat, samples
+
+
+# Stack the merged reports of one rank from any number of classifiers into a sparse taxon x (classifier, sample) matrix
+# Taxa are joined on clade name, as different classifiers don't always agree on the taxonomic ID
+def read_final_reports(fis, chunksize = 10000):
+    index = {}
+    mats, names = [], []
+    for f in fis:
+        classifier, keys, m, samples = read_report_matrix(f, chunksize)
+        idx = np.fromiter((index.setdefault(k[0], len(index)) for k in keys), dtype = np.int64, count = len(keys))
+        m = m.tocoo()
+        mats.append((idx[m.row], m.col + len(names), m.data))
+        names.extend((classifier, s) for s in samples)
+    mat = sparse.csc_matrix((np.concatenate([m[2] for m in mats]) if mats else [], \
+        (np.concatenate([m[0] for m in mats]) if mats else [], np.concatenate([m[1] for m in mats]) if mats else [])), \
+        shape = (len(index), len(names)))
+    mat.data[mat.data < 0] = 0
+    mat.eliminate_zeros()
+    return mat, names
+
+
+# Richness, Shannon index (natural log), and Gini-Simpson index of each column, on abundances scaled to sum to 1
+def alpha_diversity(mat):
+    mat = mat.tocsc()
+    counts = np.diff(mat.indptr)
+    totals = np.asarray(mat.sum(axis = 0)).ravel()
+    p = mat.data / np.repeat(np.where(totals > 0, totals, 1), counts)
+    shannon = sparse.csc_matrix((-p * np.log(p), mat.indices, mat.indptr), shape = mat.shape).sum(axis = 0)
+    simpson = sparse.csc_matrix((p * p, mat.indices, mat.indptr), shape = mat.shape).sum(axis = 0)
+    simpson = np.where(totals > 0, 1 - np.asarray(simpson).ravel(), 0)
+    return counts, np.asarray(shannon).ravel(), simpson
+
+
+# Bray-Curtis and Jaccard dissimilarities of every pair of columns, written a block of chunk x chunk columns at a time
+# so that memory is bounded by the block rather than the number of samples
+# Bray-Curtis is 1 - 2 * sum(min(u, v)) / (sum(u) + sum(v)), where only taxa in v need to be looked at
+def beta_diversity(mat, names, fo, chunk = 256):
+    mat = mat.tocsc()
+    indptr, indices, data = mat.indptr, mat.indices, mat.data
+    pa = mat.copy()
+    pa.data = np.ones_like(pa.data)
+    counts = np.diff(pa.indptr)
+    totals = np.asarray(mat.sum(axis = 0)).ravel()
+    n = mat.shape[1]
+    header = True
+    with open(fo, 'w') as f_out:
+        for i in range(0, n, chunk):
+            a = np.arange(i, min(i + chunk, n))
+            dense = mat[:, a].T.toarray()
+            for j in range(i, n, chunk):
+                b = np.arange(j, min(j + chunk, n))
+                shared = np.empty((len(a), len(b)))
+                for k, c in enumerate(b):
+                    rows = indices[indptr[c]:indptr[c + 1]]
+                    shared[:, k] = np.minimum(dense[:, rows], data[indptr[c]:indptr[c + 1]]).sum(axis = 1)
+                denom = totals[a][:, None] + totals[b][None, :]
+                with np.errstate(invalid = 'ignore', divide = 'ignore'): # Two empty columns have no Bray-Curtis
+                    bc = 1 - 2 * shared / denom
+                inter = (pa[:, a].T @ pa[:, b]).toarray()
+                union = counts[a][:, None] + counts[b][None, :] - inter
+                jac = np.where(union > 0, 1 - inter / np.maximum(union, 1), 0)
+                x, y = np.nonzero(a[:, None] < b[None, :]) # Each pair once
+                out = pd.DataFrame({'classifier_1' : [names[k][0] for k in a[x]], 'sample_1' : [names[k][1] for k in a[x]], \
+                                    'classifier_2' : [names[k][0] for k in b[y]], 'sample_2' : [names[k][1] for k in b[y]], \
+                                    'bray_curtis' : bc[x, y], 'jaccard' : jac[x, y]})
+                out.to_csv(f_out, header = header, index = False)
+                header = False
+        if header: # Fewer than two columns
+            f_out.write('classifier_1,sample_1,classifier_2,sample_2,bray_curtis,jaccard\n')
+
+
+# Alpha and/or beta diversity of every classifier and sample from the merged reports of one rank, as tidy tables
+def diversity(fis, alpha_fo = None, beta_fo = None, chunk = 256):
+    mat, names = read_final_reports(fis)
+    if alpha_fo:
+        richness, shannon, simpson = alpha_diversity(mat)
+        pd.DataFrame({'classifier' : [c for c, _ in names], 'sample' : [s for _, s in names], 'richness' : richness, \
+                      'shannon' : shannon, 'simpson' : simpson}).to_csv(alpha_fo, header = True, index = False)
+    if beta_fo:
+        beta_diversity(mat, names, beta_fo, chunk)
+
+
+PARQUET_COLS = ['clade', 'tax_id', 'sample', 'abundance'] # Plus the classifier and rank partition keys
+
+
+# Long-form copy of the merged reports {classifier}_{rank}.csv without zero abundances, as a Parquet dataset
+# partitioned by classifier and rank (store_dir/classifier=.../rank=.../part-0.parquet)
+# Samples are written in sorted order, whole samples per row group, so that the row groups' statistics let
+# readers skip the samples they don't ask for; strings are dictionary-encoded in the files
+def write_parquet_store(fis, store_dir, row_group = 1 << 20, chunksize = 10000):
+    import pyarrow as pa # Optional, only needed for the Parquet store
+    import pyarrow.parquet as pq
+    schema = pa.schema([('clade', pa.string()), ('tax_id', pa.string()), ('sample', pa.string()), ('abundance', pa.float64())])
+    for f in fis:
+        classifier, rank = basename(f)[:-len('.csv')].rsplit('_', 1)
+        _, keys, mat, samples = read_report_matrix(f, chunksize)
+        order = np.argsort(np.array(samples, dtype = str), kind = 'stable')
+        mat = mat[:, order].tocsc()
+        mat.sum_duplicates()
+        mat.eliminate_zeros()
+        clades = pa.array([k[0] for k in keys], pa.string())
+        taxids = pa.array([k[1] for k in keys], pa.string())
+        names = pa.array([samples[j] for j in order], pa.string())
+        out_dir = join(store_dir, 'classifier=' + classifier, 'rank=' + rank)
+        makedirs(out_dir, exist_ok = True)
+        fo = join(out_dir, 'part-0.parquet')
+        indptr = mat.indptr
+        with pq.ParquetWriter(fo + '.tmp', schema, use_dictionary = True) as writer:
+            start = 0
+            while start < len(order):
+                end = max(int(np.searchsorted(indptr, indptr[start] + row_group, side = 'right')) - 1, start + 1)
+                rows = pa.array(mat.indices[indptr[start]:indptr[end]].astype(np.int32))
+                cols = pa.array(np.repeat(np.arange(start, end, dtype = np.int32), np.diff(indptr[start:end + 1])))
+                writer.write_table(pa.table([clades.take(rows), taxids.take(rows), names.take(cols), \
+                    pa.array(mat.data[indptr[start]:indptr[end]])], schema = schema))
+                start = end
+        os.replace(fo + '.tmp', fo)
+
+
+# Rows of the Parquet store that match every filter given (each a list of values to keep), as a DataFrame
+# The files are memory-mapped, and only the columns, partitions, and row groups that can match are read
+def read_parquet_store(store_dir, samples = None, clades = None, tax_ids = None, classifiers = None, ranks = None, \
+                       columns = None):
+    import pyarrow.parquet as pq # Optional, only needed for the Parquet store
+    filters = [(c, 'in', list(v)) for c, v in [('sample', samples), ('clade', clades), ('tax_id', tax_ids), \
+               ('classifier', classifiers), ('rank', ranks)] if v is not None]
+    table = pq.read_table(store_dir, columns = columns, filters = filters if filters else None, memory_map = True, \
+                          partitioning = 'hive')
+    return table.to_pandas()
+
+
+K2D_FILES = ['hash.k2d', 'opts.k2d', 'taxo.k2d']
+
+
+# Make the database's tables available for kraken2 --memory-mapping, so that every process on the node shares 
+# one resident copy: copied once into stage_dir (ex. /dev/shm) if given, otherwise read once to warm the page cache
+class Kraken2_DB_Stage:
+    '''A Kraken2 database copied to stage_dir (ex. /dev/shm) for the batches running on a node, and removed 
+    once the last of them finishes. Without a stage_dir, the database is read in place into the page cache.'''
+
+    def __init__(self, database, stage_dir = ''):
+        self.database = database
+        self.stage_dir = stage_dir
+        self.path = database
+        self.users = None
+
+    def stage(self):
+        fis = [join(self.database, f) for f in K2D_FILES]
+        missing = [basename(f) for f in fis if not exists(f)]
+        if missing:
+            raise ValueError('{}: not a Kraken2 database, missing {}'.format(self.database, ', '.join(missing)))
+        if not self.stage_dir:
+            buf = bytearray(BLOCK_SIZE)
+            for f in fis:
+                with open(f, 'rb', buffering = 0) as f_in:
+                    while f_in.readinto(buf):
+                        pass
+            return self.path
+        self.path = join(self.stage_dir, 'kraken2_' + hashlib.blake2b(abspath(self.database).encode(), digest_size = 8).hexdigest())
+        with open(self.path + '.lock', 'w') as l:
+            fcntl.flock(l, fcntl.LOCK_EX) # Batches starting together on a node wait for a single copy
+            makedirs(self.path, exist_ok = True)
+            for f in fis:
+                fo = join(self.path, basename(f))
+                st = os.stat(f)
+                if exists(fo) and os.stat(fo).st_size == st.st_size and os.stat(fo).st_mtime_ns == st.st_mtime_ns:
+                    continue
+                shutil.copyfile(f, fo + '.tmp')
+                os.utime(fo + '.tmp', ns = (st.st_atime_ns, st.st_mtime_ns))
+                os.replace(fo + '.tmp', fo)
+            # Every batch using the copy holds a shared lock on it until it finishes (or is killed)
+            self.users = open(self.path + '.users', 'w')
+            fcntl.flock(self.users, fcntl.LOCK_SH)
+            fcntl.flock(l, fcntl.LOCK_UN)
+        return self.path
+
+    def release(self):
+        if self.users is None:
+            return
+        with open(self.path + '.lock', 'w') as l:
+            fcntl.flock(l, fcntl.LOCK_EX) # Batches starting meanwhile wait, then copy the database again
+            fcntl.flock(self.users, fcntl.LOCK_UN)
+            try:
+                fcntl.flock(self.users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(self.path, ignore_errors = True) # No other batch is using the copy
+                print('Removed {}'.format(self.path), file = sys.stderr)
+            except BlockingIOError:
+                pass
+            self.users.close()
+            self.users = None
+            fcntl.flock(l, fcntl.LOCK_UN)
+
+    def __enter__(self):
+        return self.stage()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def classify_kraken2(kraken_exec, db, sample, fqs, out_dir, log_dir, threads):
+    makedirs(join(out_dir, sample), exist_ok = True)
+    cmd = [kraken_exec, '--db', db, '--memory-mapping', '--threads', str(threads), \
+           '--report', join(out_dir, sample, 'kreport.tsv'), '--output', join(out_dir, sample, 'kraken.tsv'), '--paired'] + fqs
+    with open(join(log_dir, sample + '.out'), 'w') as log:
+        return sample, cmd, subprocess.call(cmd, stdout = log, stderr = subprocess.STDOUT)
+
+
+# Classify a batch of samples side by side against the shared database, at most threads of them at a time
+# and splitting the threads between those running
+# Writes out_dir/{sample}/kraken.tsv and kreport.tsv, and each sample's kraken2 log to log_dir/{sample}.out
+def run_kraken2_batch(kraken_exec, database, reads, out_dir, log_dir, threads = 1, stage_dir = ''):
+    start = time.time()
+    makedirs(log_dir, exist_ok = True)
+    n = min(len(reads), max(int(threads), 1))
+    with Kraken2_DB_Stage(database, stage_dir) as db:
+        print('Staged {} as {} in {:.1f} s'.format(database, db, time.time() - start), file = sys.stderr)
+        with ThreadPoolExecutor(max_workers = n) as pool:
+            jobs = [pool.submit(classify_kraken2, kraken_exec, db, s, fqs, out_dir, log_dir, max(threads // n, 1)) \
+                    for s, fqs in reads.items()]
+            failed = [j.result() for j in jobs if j.result()[2]]
+    for s, cmd, rc in failed:
+        print('{}: kraken2 exited with {}, see {}'.format(s, rc, join(log_dir, s + '.out')), file = sys.stderr)
+    if failed:
+        raise subprocess.CalledProcessError(failed[0][2], failed[0][1])
+    print('Classified {} samples in {:.1f} s'.format(len(reads), time.time() - start), file = sys.stderr)
+
+
+def xtree_stamp(fq, database, xtree_exec, cmd):
+    # Fields of a sample's done marker: the input, the database, the executable, and the full command line
+    st, db = os.stat(fq), os.stat(database)
+    return [fq, str(st.st_size), str(st.st_mtime_ns), fast_hash(fq), database, str(db.st_size), str(db.st_mtime_ns), \
+            xtree_exec, ' '.join(cmd)]
+
+
+def xtree_done(marker, fq, database, xtree_exec, cmd):
+    # Whether a sample's done marker records the same input, database, executable, and command as now
+    try:
+        with open(marker, 'r') as f_in:
+            fields = f_in.readline().rstrip('\n').split('\t')
+        db = os.stat(database)
+    except OSError:
+        return False
+    if len(fields) != 9:
+        return False
+    source, size, mtime_ns, hsh, db_path, db_size, db_mtime_ns, exe, line = fields
+    if [source, db_path, exe, line] != [fq, database, xtree_exec, ' '.join(cmd)]:
+        return False
+    if [db_size, db_mtime_ns] != [str(db.st_size), str(db.st_mtime_ns)]:
+        return False
+    return file_unchanged(fq, size, mtime_ns, hsh)
+
+
+# Align a batch of samples one after another against one XTree database, so that it is read from disk once per
+# batch and from the page cache after that
+# Writes out_dir/{sample}.ref and .cov, then a {sample}.done marker recording the input, database, executable and
+# command, so that a restarted batch skips the samples it already finished (these files aren't the rule's outputs,
+# which Snakemake would delete)
+# Markers are only trusted while out_dir/.in_progress is left behind by a failed or killed attempt; a batch that
+# finished and is run again (ex. forced) starts over
+def run_xtree_batch(xtree_exec, database, reads, out_dir, logs, threads = 1):
+    start = time.time()
+    makedirs(out_dir, exist_ok = True)
+    in_progress = join(out_dir, '.in_progress')
+    if not exists(in_progress):
+        for s in reads:
+            if exists(join(out_dir, s + '.done')):
+                os.remove(join(out_dir, s + '.done'))
+        open(in_progress, 'w').close()
+    done = 0
+    for s, fq in reads.items():
+        ref, cov, marker = join(out_dir, s + '.ref'), join(out_dir, s + '.cov'), join(out_dir, s + '.done')
+        cmd = [xtree_exec, '--seqs', fq, '--threads', str(threads), '--db', database, '--ref-out', ref, \
+               '--cov-out', cov, '--redistribute']
+        if xtree_done(marker, fq, database, xtree_exec, cmd) and exists(ref) and exists(cov):
+            print('{}: already aligned, skipping'.format(s), file = sys.stderr)
+            continue
+        if exists(marker):
+            os.remove(marker)
+        makedirs(dirname(logs[s]), exist_ok = True)
+        with open(logs[s], 'w') as log:
+            rc = subprocess.call(cmd, stdout = log, stderr = subprocess.STDOUT)
+        if rc:
+            print('{}: xtree exited with {}, see {}'.format(s, rc, logs[s]), file = sys.stderr)
+            raise subprocess.CalledProcessError(rc, cmd)
+        with open(marker + '.tmp', 'w') as f_out:
+            f_out.write('\t'.join(xtree_stamp(fq, database, xtree_exec, cmd)) + '\n')
+        os.replace(marker + '.tmp', marker)
+        done += 1
+    os.remove(in_progress)
+    print('Aligned {} of {} samples against {} in {:.1f} s'.format(done, len(reads), database, time.time() - start), \
+          file = sys.stderr)
 
 
+def read_id(l):
+    # ID of a Kraken2 output or FASTQ header line, without any mate suffix
+    rid = l.split(b'\t')[1] if l[:1] in [b'C', b'U'] else l[1:].split()[0]
+    return rid[:-2] if rid[-2:] in [b'/1', b'/2'] else rid
 
 
+# Stream Kraken2's per-read output alongside both mates' FASTQs, which are in the same order, 
+# and write out the read pairs Kraken2 left unclassified in one pass
+def extract_unclassified_kraken(kraken, fwd, rev, fwd_out, rev_out, threads = 1):
+    start = time.time()
+    num_recs = 0
+    num_unc = 0
+    readers = [Line_Reader(kraken), Line_Reader(fwd), Line_Reader(rev)]
+    try:
+        with Block_Writer(fwd_out, threads) as o1, Block_Writer(rev_out, threads) as o2:
+            while True:
+                k_lines = readers[0].take(RECORD_BATCH)
+                if not k_lines:
+                    break
+                n = len(k_lines)
+                l1 = readers[1].take(4 * n)
+                l2 = readers[2].take(4 * n)
+                if len(l1) < 4 * n or len(l2) < 4 * n:
+                    raise ValueError('{}: more reads classified than found in {} and {}'.format(kraken, fwd, rev))
+                for i in [0, n - 1]: # Spot-check that the three files are still in step
+                    if not read_id(k_lines[i]) == read_id(l1[4 * i]) == read_id(l2[4 * i]):
+                        raise ValueError('{}: read {} is out of step with {} and {}'.format(kraken, num_recs + i + 1, fwd, rev))
+                unc = [i for i, l in enumerate(k_lines) if l[:1] == b'U']
+                if unc:
+                    o1.write(b''.join([b'\n'.join(l1[4 * i:4 * i + 4]) + b'\n' for i in unc]))
+                    o2.write(b''.join([b'\n'.join(l2[4 * i:4 * i + 4]) + b'\n' for i in unc]))
+                num_recs += n
+                num_unc += len(unc)
+            if readers[1].take(1) or readers[2].take(1):
+                raise ValueError('{}: fewer reads classified than found in {} and {}'.format(kraken, fwd, rev))
+    finally:
+        for r in readers:
+            r.close()
+    secs = max(time.time() - start, 1e-9)
+    print('{}: {} of {} read pairs unclassified, in {:.1f} s ({:.0f} records/s)'.format(kraken, num_unc, num_recs, secs, num_recs / secs), file = sys.stderr)
+    return num_unc